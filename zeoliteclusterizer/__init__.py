@@ -1 +1 @@
-__all__ = ['clusterizer', 'extraframework', 'gaussian', 'scaffolds']
+__all__ = ['atoms', 'benchmark', 'cli', 'clusterizer', 'extraframework', 'filters', 'gaussian', 'geometry', 'instrument', 'scaffolds', 'synthetic']
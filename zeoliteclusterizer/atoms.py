@@ -0,0 +1,122 @@
+import numpy as np
+import re
+
+'''
+Single bond covalent radii in angstroms (Cordero et al., 2008) for the
+elements likely to show up in scaffolds, metals and ligands.  Unknown
+elements fall back to default_radius
+'''
+covalent_radii = {
+	'H': 0.31, 'He': 0.28, 'Li': 1.28, 'Be': 0.96, 'B': 0.84, 'C': 0.76,
+	'N': 0.71, 'O': 0.66, 'F': 0.57, 'Na': 1.66, 'Mg': 1.41, 'Al': 1.21,
+	'Si': 1.11, 'P': 1.07, 'S': 1.05, 'Cl': 1.02, 'K': 2.03, 'Ca': 1.76,
+	'Sc': 1.70, 'Ti': 1.60, 'V': 1.53, 'Cr': 1.39, 'Mn': 1.39, 'Fe': 1.32,
+	'Co': 1.26, 'Ni': 1.24, 'Cu': 1.32, 'Zn': 1.22, 'Ga': 1.22, 'Ge': 1.20,
+	'As': 1.19, 'Se': 1.20, 'Br': 1.20, 'Y': 1.90, 'Zr': 1.75, 'Nb': 1.64,
+	'Mo': 1.54, 'Tc': 1.47, 'Ru': 1.46, 'Rh': 1.42, 'Pd': 1.39, 'Ag': 1.45,
+	'Cd': 1.44, 'Sn': 1.39, 'I': 1.39, 'Hf': 1.75, 'Ta': 1.70, 'W': 1.62,
+	'Re': 1.51, 'Os': 1.44, 'Ir': 1.41, 'Pt': 1.36, 'Au': 1.36, 'Hg': 1.32,
+}
+default_radius = 1.50
+
+def elementSymbol(label):
+	'''
+	Returns the element symbol of a Gaussian atom label such as 'O', 'O1' or
+	'Si-Si_x'
+	'''
+	match = re.match('[A-Za-z]{1,2}', label)
+	if match is None:
+		return label
+	symbol = match.group(0).capitalize()
+	if symbol not in covalent_radii and symbol[:1] in covalent_radii:
+		return symbol[:1]
+	return symbol
+
+def covalentRadii(elements):
+	'''
+	Returns an array of covalent radii for an array of atom labels
+	'''
+	return np.array([covalent_radii.get(elementSymbol(str(e)), default_radius)
+							for e in elements], dtype=np.float64)
+
+class AtomTable(object):
+	'''
+	A compact, numeric table of atoms shared by scaffolds, binding modes,
+	ligands and conformations.  Holds an array of element labels, an int8
+	array of Gaussian frozen flags (0 or -1) and an (N,3) float64 array of
+	cartesian coordinates, so geometry stays numeric from parsing to writing.
+
+	Indexing with an int returns the old style [element, frozen, x, y, z]
+	row for convenience, while slices and index arrays return new tables.
+	Tables are treated as immutable; methods that change atoms return a new
+	table.
+	'''
+	def __init__(self, elements, frozen, coords):
+		self.elements = np.asarray(elements, dtype=str)
+		self.frozen = np.asarray(frozen, dtype=np.int8).reshape(-1)
+		self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+	@classmethod
+	def fromRows(cls, rows):
+		'''
+		Builds a table from rows of [element, frozen, x, y, z] or
+		[element, x, y, z], where the values may be strings or numbers
+		'''
+		elements, frozen, coords = [], [], []
+		for row in rows:
+			elements.append(str(row[0]))
+			if len(row) > 4:
+				frozen.append(int(row[1]))
+				coords.append(row[2:5])
+			else:
+				frozen.append(0)
+				coords.append(row[1:4])
+		return cls(elements, frozen, np.array(coords, dtype=np.float64))
+
+	@classmethod
+	def concatenate(cls, tables):
+		tables = list(tables)
+		if not tables:
+			return cls([], [], np.zeros((0, 3)))
+		return cls(np.concatenate([t.elements for t in tables]),
+						np.concatenate([t.frozen for t in tables]),
+						np.concatenate([t.coords for t in tables]))
+
+	def __len__(self):
+		return len(self.elements)
+
+	def __getitem__(self, index):
+		if isinstance(index, (int, np.integer)):
+			x, y, z = self.coords[index].tolist()
+			return [str(self.elements[index]), int(self.frozen[index]), x, y, z]
+		return AtomTable(self.elements[index], self.frozen[index],
+								self.coords[index])
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+	def __repr__(self):
+		return 'AtomTable(%s)' % ', '.join(str(row) for row in self)
+
+	def copy(self):
+		return AtomTable(self.elements.copy(), self.frozen.copy(),
+								self.coords.copy())
+
+	def mask(self, element):
+		'''
+		Returns a boolean array marking atoms with the given element label
+		'''
+		return self.elements == element
+
+	def replaceElement(self, index, element):
+		'''
+		Returns a copy of the table with the element at index replaced.  The
+		label array is widened if the new label is longer
+		'''
+		elements = self.elements.astype(object)
+		elements[index] = element
+		return AtomTable(elements.astype(str), self.frozen, self.coords)
+
+	def translated(self, vector):
+		return AtomTable(self.elements, self.frozen, self.coords + vector)
@@ -0,0 +1,223 @@
+'''
+Benchmarks each stage of a screen on synthetic inputs (see synthetic) and
+records time and throughput of each stage, and the peak memory of the
+whole run, as JSON.  For example
+
+	python benchmark.py --preset medium --save baseline.json
+	python benchmark.py --preset medium --compare baseline.json
+
+The second run exits with status 1 if any stage got slower, or the whole
+run's peak memory grew, by more than --tolerance over the baseline.  Peak
+memory is a high water mark of the process, so it is only meaningful for
+the run as a whole, not per stage.  Inputs and outputs go to a temporary
+directory, on tmpfs (/dev/shm) when available, so disk speed matters as
+little as possible.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+try:
+	import resource
+except ImportError:
+	resource = None
+from clusterizer import Clusterizer
+from gaussian import G09Output
+from scaffolds import BindingMode, ScaffoldRing
+import synthetic
+
+presets = {
+	'small': {'atoms': 24, 'modes': 12, 'sites': 3, 'metals': 4, 'ligands': 3},
+	'medium': {'atoms': 48, 'modes': 40, 'sites': 4, 'metals': 10, 'ligands': 5},
+	'large': {'atoms': 96, 'modes': 120, 'sites': 5, 'metals': 20, 'ligands': 8},
+}
+
+def peakRSS():
+	'''
+	Returns the peak resident set size the process has reached so far in
+	bytes, or None where it can't be measured
+	'''
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, macOS bytes
+	return peak if sys.platform == 'darwin' else peak*1024
+
+def timeStage(func):
+	'''
+	Returns (result, seconds) of calling func
+	'''
+	start = time.time()
+	result = func()
+	return result, time.time() - start
+
+def runOnce(config, workdir):
+	'''
+	Runs every stage once on freshly generated inputs and returns a dict of
+	stage name to seconds and item counts
+	'''
+	inputs = os.path.join(workdir, 'inputs')
+	output = os.path.join(workdir, 'output')
+	scaffoldPath, modePaths = synthetic.makeScreen(inputs, config['atoms'],
+										config['modes'], config['sites'], config['seed'])
+	metals = synthetic.makeMetals(config['metals'])
+	ligands = synthetic.makeLigands(config['ligands'])
+	os.makedirs(output)
+
+	stages = {}
+	def record(name, seconds, items, unit):
+		stages[name] = {'seconds': seconds, 'items': items, 'unit': unit,
+								'perSecond': items / seconds if seconds > 0 else None}
+
+	def parse():
+		scaffold = ScaffoldRing(scaffoldPath)
+		return scaffold, [BindingMode(path, scaffold.atom_list)
+									for path in modePaths]
+	(scaffold, modes), seconds = timeStage(parse)
+	record('parse', seconds, len(modePaths) + 1, 'files')
+
+	def enumerateCombos():
+		clusterizer = Clusterizer(scaffold, modes, metals, ligands,
+								charges=[0], unpaired=[[0]], mix_ligands=config['mix'],
+								lazy=True, workers=config['workers'])
+		return clusterizer, list(clusterizer.iterCombinations())
+	(clusterizer, combos), seconds = timeStage(enumerateCombos)
+	record('enumerate', seconds, len(combos), 'combinations')
+
+	absModes, seconds = timeStage(lambda: list(clusterizer.iterModes(combos)))
+	record('conformers', seconds, sum(len(mode.conformations)
+										for mode in absModes), 'conformations')
+
+	def write():
+		with G09Output(output, writers=config['writers']) as writer:
+			writer.writeAllModes(absModes)
+		return len(os.listdir(output))
+	files, seconds = timeStage(write)
+	record('write', seconds, files, 'files')
+	stages['write']['bytes'] = sum(os.path.getsize(os.path.join(output, name))
+												for name in os.listdir(output))
+	return stages
+
+def runBenchmark(config, repeat=3, tmpdir=None):
+	'''
+	Runs the stages repeat times and keeps the fastest time of each stage.
+	peakRSS is the peak of the whole benchmark process
+	'''
+	if tmpdir is None and os.path.isdir('/dev/shm'):
+		tmpdir = '/dev/shm'
+	best = {}
+	for _ in range(repeat):
+		workdir = tempfile.mkdtemp(prefix='zcbench', dir=tmpdir)
+		try:
+			stages = runOnce(config, workdir)
+		finally:
+			shutil.rmtree(workdir, ignore_errors=True)
+		for name, stage in stages.items():
+			if name not in best or stage['seconds'] < best[name]['seconds']:
+				best[name] = stage
+
+	return {'config': config, 'repeat': repeat, 'stages': best,
+				'peakRSS': peakRSS(), 'python': platform.python_version(),
+				'numpy': np.__version__, 'platform': platform.platform(),
+				'tmpdir': tmpdir or tempfile.gettempdir(), 'date': time.time()}
+
+def compare(results, baseline, tolerance=0.2):
+	'''
+	Returns the lines of a comparison against a baseline, and whether any
+	stage is slower, or the whole run peak RSS larger, than the baseline by
+	more than tolerance
+	'''
+	lines = ['%-12s %12s %12s %8s' % ('stage', 'baseline', 'now', 'change')]
+	regressed = False
+	for name in sorted(results['stages']):
+		now = results['stages'][name]['seconds']
+		then = baseline.get('stages', {}).get(name, {}).get('seconds')
+		if not then:
+			lines.append('%-12s %12s %11.4fs %8s' % (name, '-', now, 'new'))
+			continue
+		change = now / then - 1.0
+		flag = ''
+		if change > tolerance:
+			regressed = True
+			flag = '  slower'
+		lines.append('%-12s %11.4fs %11.4fs %+7.1f%%%s' % (name, then, now,
+							100*change, flag))
+
+	now, then = results.get('peakRSS'), baseline.get('peakRSS')
+	if now and then:
+		change = float(now) / then - 1.0
+		flag = ''
+		if change > tolerance:
+			regressed = True
+			flag = '  larger'
+		lines.append('%-12s %8.1f MiB %8.1f MiB %+7.1f%%%s' % ('peak RSS',
+							then / 1048576.0, now / 1048576.0, 100*change, flag))
+	if baseline.get('config') != results['config']:
+		lines.append('Warning: the baseline was run with a different config')
+	return lines, regressed
+
+def formatResults(results):
+	lines = ['%-12s %10s %22s %12s' % ('stage', 'seconds', 'items',
+						'per second')]
+	for name in ('parse', 'enumerate', 'conformers', 'write'):
+		stage = results['stages'][name]
+		lines.append('%-12s %10.4f %22s %12s' % (name, stage['seconds'],
+						'%d %s' % (stage['items'], stage['unit']),
+						'%.0f' % stage['perSecond'] if stage['perSecond'] else '-'))
+	rss = results['peakRSS']
+	lines.append('Whole run peak RSS: %s' % ('%.1f MiB' % (rss / 1048576.0)
+						if rss else '-'))
+	return lines
+
+def makeParser():
+	parser = argparse.ArgumentParser(description='Benchmark the stages of a '
+									'screen on synthetic inputs')
+	parser.add_argument('--preset', choices=sorted(presets), default='small')
+	for key in ('atoms', 'modes', 'sites', 'metals', 'ligands'):
+		parser.add_argument('--' + key, type=int,
+									help='Override the preset number of %s' % key)
+	parser.add_argument('--no-mix', dest='mix', action='store_false')
+	parser.add_argument('--workers', type=int, default=None)
+	parser.add_argument('--writers', type=int, default=0)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=3)
+	parser.add_argument('--tmpdir', help='Where to generate and write files')
+	parser.add_argument('--save', metavar='FILE', help='Write results as JSON')
+	parser.add_argument('--compare', metavar='FILE', help='Baseline JSON')
+	parser.add_argument('--tolerance', type=float, default=0.2,
+									help='Allowed slowdown before failing, 0.2 is 20%%')
+	return parser
+
+def main(argv=None):
+	args = makeParser().parse_args(argv)
+	config = dict(presets[args.preset])
+	for key in config:
+		if getattr(args, key) is not None:
+			config[key] = getattr(args, key)
+	config.update({'mix': args.mix, 'workers': args.workers,
+						'writers': args.writers, 'seed': args.seed})
+
+	results = runBenchmark(config, args.repeat, args.tmpdir)
+	print('\n'.join(formatResults(results)))
+
+	if args.save:
+		with open(args.save, 'w') as outfile:
+			json.dump(results, outfile, indent=1, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as infile:
+			baseline = json.load(infile)
+		lines, regressed = compare(results, baseline, args.tolerance)
+		print('')
+		print('\n'.join(lines))
+		if regressed:
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
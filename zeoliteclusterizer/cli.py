@@ -0,0 +1,185 @@
+'''
+Command line interface for screening a scaffold.  For example
+
+	python cli.py ring.com binding_sites/ --metal Sc:1,3 --metal Ti:2,4 \
+		--ligand OH --ligand Hydride --charge 0 --output screen/
+
+writes every conformation to screen/, while --dry-run only reports how many
+files and bytes the same screen would produce.  Array jobs can each pass
+--shard i/N to write only their part of the screen, named exactly as in a
+single run.  Metals are given as name:charges[:unpaired], with comma
+separated lists and unpaired electrons defaulting to 0.  Ligands are the
+names of the common ligands in extraframework.
+'''
+import argparse
+import json
+import os
+import sys
+from clusterizer import Clusterizer
+from extraframework import Metal, hydroxide, hydride, oxide
+from filters import ScoreFilter
+from gaussian import G09Output
+from instrument import stats
+from scaffolds import BindingModeSet, ScaffoldRing
+
+common_ligands = dict((lig.name, lig) for lig in (hydroxide, hydride, oxide))
+
+def parseInts(text):
+	return [int(value) for value in text.split(',') if value != '']
+
+def parseMetal(text):
+	'''
+	Returns a Metal from name:charges[:unpaired], e.g. Sc:1,3 or V:3:0,2
+	'''
+	fields = text.split(':')
+	if len(fields) not in (2, 3) or not fields[0]:
+		raise argparse.ArgumentTypeError('Metals are given as '
+										'name:charges[:unpaired], not %s' % text)
+	try:
+		charges = parseInts(fields[1])
+		unpaired = parseInts(fields[2]) if len(fields) == 3 else [0]
+	except ValueError:
+		raise argparse.ArgumentTypeError('Bad charges or unpaired in %s' % text)
+	return Metal(fields[0], charges, unpaired)
+
+def parseShard(text):
+	'''
+	Returns (index, count) from index/count, e.g. 0/8 to 7/8
+	'''
+	try:
+		index, count = [int(value) for value in text.split('/')]
+	except ValueError:
+		raise argparse.ArgumentTypeError('Shards are given as index/count, '
+										'not %s' % text)
+	if count < 1 or not 0 <= index < count:
+		raise argparse.ArgumentTypeError('Shard index must be 0 to count-1, '
+										'not %s' % text)
+	return index, count
+
+def parseLigand(text):
+	if text not in common_ligands:
+		raise argparse.ArgumentTypeError('Unknown ligand %s, choose from %s' %
+									(text, ', '.join(sorted(common_ligands))))
+	return common_ligands[text]
+
+def makeParser():
+	parser = argparse.ArgumentParser(description='Screen metals and ligands '
+									'over the binding modes of a zeolite scaffold')
+	parser.add_argument('scaffold', help='Gaussian input of the bare scaffold')
+	parser.add_argument('binding', nargs='+',
+									help='Binding mode inputs or directories of them')
+	parser.add_argument('--metal', type=parseMetal, action='append',
+									required=True, help='name:charges[:unpaired]')
+	parser.add_argument('--ligand', type=parseLigand, action='append',
+									required=True, help='One of %s' %
+									', '.join(sorted(common_ligands)))
+	parser.add_argument('--charge', type=int, action='append',
+									help='Total charge of the cluster, default 0')
+	parser.add_argument('--unpaired', type=parseInts, action='append',
+									help='Unpaired electrons for each --charge, '
+									'comma separated, default 0')
+	parser.add_argument('--no-mix', dest='mix', action='store_false',
+									help='Only use one kind of ligand per metal')
+	parser.add_argument('--no-symmetry', dest='symmetry', action='store_false',
+									help='Keep symmetry equivalent arrangements')
+	parser.add_argument('--top', type=int, default=None, metavar='K',
+									help='Only write the K best scoring conformations of '
+									'each combination, see ScoreFilter')
+	parser.add_argument('--top-per', choices=['combination', 'metal'],
+									default='combination', help='Group for --top')
+	parser.add_argument('--workers', type=int, default=None,
+									help='Processes for building conformations')
+	parser.add_argument('--writers', type=int, default=0,
+									help='Background writer threads')
+	parser.add_argument('--shard', type=parseShard, default=None,
+									help='Only write shard index/count (0 based) of the '
+									'screen, e.g. $SLURM_ARRAY_TASK_ID/16')
+	parser.add_argument('--output', default='.', help='Output directory')
+	parser.add_argument('--makedirs', action='store_true',
+									help='Put each input file in its own directory')
+	parser.add_argument('--dry-run', action='store_true',
+									help='Only estimate the number and size of files of '
+									'the whole screen')
+	parser.add_argument('--json', action='store_true',
+									help='Print the dry run estimate as JSON')
+	parser.add_argument('--stats', metavar='FILE',
+									help='Write stage timings and counters as JSON')
+	parser.add_argument('--profile', metavar='STAGE', action='append',
+									help='Capture a cProfile of a stage, e.g. write')
+	parser.add_argument('--profile-dir', default='profiles',
+									help='Directory for the <stage>.prof files')
+	return parser
+
+def buildClusterizer(args):
+	charges = args.charge or [0]
+	unpaired = args.unpaired or [[0]]*len(charges)
+	if len(unpaired) != len(charges):
+		raise SystemExit('Give one --unpaired per --charge')
+	scaffold = ScaffoldRing(args.scaffold)
+	modes = BindingModeSet(args.binding, scaffold, workers=args.workers)
+	filters = []
+	if args.top is not None:
+		filters.append(ScoreFilter(scaffold, top=args.top, per=args.top_per))
+	return Clusterizer(scaffold, modes, args.metal, args.ligand,
+								charges=charges, unpaired=unpaired, mix_ligands=args.mix,
+								lazy=True, symmetry=args.symmetry, filters=filters,
+								workers=args.workers, shard=args.shard)
+
+def formatBytes(size):
+	for unit in ('B', 'KiB', 'MiB', 'GiB'):
+		if size < 1024 or unit == 'GiB':
+			return '%.1f %s' % (size, unit) if unit != 'B' else '%d B' % size
+		size /= 1024.0
+
+def formatEstimate(estimate):
+	'''
+	Returns the lines of a plain text table of an estimate from
+	Clusterizer.estimateOutput
+	'''
+	row = '%-12s %12s %10s %12s %12s'
+	lines = [row % ('metal', 'combinations', 'files', 'size', 'on disk')]
+	for name, totals in sorted(estimate['metals'].items()):
+		lines.append(row % (name, totals['combinations'], totals['files'],
+						formatBytes(totals['bytes']), formatBytes(totals['diskBytes'])))
+	lines.append('')
+	row = '%-12s %12s %10s %10s %12s'
+	lines.append(row % ('ligands', 'combinations', 'modes', 'files', 'size'))
+	for ligNum, totals in sorted(estimate['buckets'].items()):
+		lines.append(row % (ligNum, totals['combinations'], totals['modes'],
+						totals['files'], formatBytes(totals['bytes'])))
+	lines.append('')
+	lines.append('%d files, %s (%s on disk)' % (estimate['files'],
+						formatBytes(estimate['bytes']), formatBytes(estimate['diskBytes'])))
+	return lines
+
+def main(argv=None):
+	args = makeParser().parse_args(argv)
+	if args.stats or args.profile:
+		stats.enable(profile=args.profile or ())
+	try:
+		return run(args)
+	finally:
+		if args.stats:
+			stats.exportJSON(args.stats)
+		if args.profile:
+			stats.saveProfiles(args.profile_dir)
+
+def run(args):
+	clusterizer = buildClusterizer(args)
+
+	if args.dry_run:
+		estimate = clusterizer.estimateOutput()
+		if args.json:
+			print(json.dumps(estimate, indent=1, sort_keys=True))
+		else:
+			print('\n'.join(formatEstimate(estimate)))
+		return 0
+
+	if not os.path.isdir(args.output):
+		os.makedirs(args.output)
+	with G09Output(args.output, writers=args.writers) as output:
+		output.writeAllModes(clusterizer.getFinalModes(), makedirs=args.makedirs)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -1,8 +1,17 @@
 
-import sys
-from extraframework import Combination
-from scaffolds import AbstractMode
-from gaussian import OutputTest
+import os
+import collections
+import heapq
+import itertools
+import json
+import multiprocessing
+import time
+from extraframework import Combination, Metal
+from scaffolds import (AbstractMode, BindingModeSet, ConformerStore, 
+							PlacementCache, countAssignments, placeLigands, 
+							placeRotamers)
+from gaussian import G09Output, ResumedMode
+from instrument import stats
 
 class Clusterizer(object):
 	'''
@@ -19,34 +28,312 @@ class Clusterizer(object):
 	(5) Write conformations to disk
 	'''
 	def __init__(self, scaffold, binding_list, metals, 
-					ligands, charges=[0], unpaired=[[0]], mix_ligands=True):
+					ligands, charges=[0], unpaired=[[0]], mix_ligands=True,
+					lazy=False, symmetry=True, filters=None, workers=None,
+					chunksize=32, shard=None, rotamers=None):
 
 		# Need hash tables of binding modes and counter charges
 		self.maxLigs = 0
 		self._modes = self.makeModesHashTable(binding_list)
 		self._cCharges = self.makeChargesHashTable(scaffold, charges, unpaired)
+		self._targets = self.makeTargets(scaffold)
+		self._chargeIndex = self.makeChargeIndex(metals, ligands)
+		self._knapsack = LigandKnapsack(self._targets, set(self._modes), ligands,
+													self.maxLigs)
+		# Orient every ligand on every site of every mode in one batch
+		placeLigands(binding_list, ligands)
+		if rotamers is not None:
+			placeRotamers(binding_list, ligands, rotamers.count, rotamers.tolerance)
+			self._knapsack.setRotamers(rotamers.rotamerCounts(binding_list, 
+												ligands), rotamers.maxStates)
+		self.scaffold = scaffold
+		self.binding_list = binding_list
+		self.metals = metals
+		self.ligands = ligands
+		self.charges = charges
+		self.unpaired = unpaired
+		self.mixLigands = mix_ligands
+		self.lazy = lazy
+		self.symmetry = symmetry
+		self.rotamers = rotamers
+		self.placementCache = PlacementCache()
+		self.filters = list(filters) if filters else []
+		self.workers = workers
+		self.chunksize = chunksize
+		self.shard = self.checkShard(shard)
 		self.combinations = []
+		self.sharedCombinations = None
 		self.finalModes = None
 
-		if mix_ligands == False:
-			for metal in metals:
-				self.makePureCombinations(scaffold, binding_list, metal, ligands, 
-													charges, unpaired)
+		# In lazy mode nothing is enumerated up front.  Combinations, matched
+		# modes and conformers are pulled through the generator chain one at a
+		# time as the writer consumes getFinalModes()
+		if lazy == False:
+			self.combinations = list(self.iterCombinations())
+			self.finalModes = ConformerStore.fromModes(
+										self.iterModes(self.combinations), scaffold)
+
+	def iterCombinations(self):
+		'''
+		Generator over the allowed Combinations of this Clusterizer's shard,
+		or all of them when it isn't sharded.  See shardCombinations
+		'''
+		combos = self.iterAllCombinations()
+		if self.shard is not None:
+			combos = self.shardCombinations(list(combos), *self.shard)
+		for combo in combos:
+			yield combo
+
+	def iterAllCombinations(self):
+		'''
+		Generator over every allowed Combination for all of the metals, in the
+		same order the eager constructor would have accumulated them.  If
+		sharedCombinations has been set, e.g. by a BatchClusterizer, those are
+		yielded instead
+		'''
+		if self.sharedCombinations is not None:
+			for combo in self.sharedCombinations:
+				yield combo
+			return
+
+		for metal in self.metals:
+			if self.mixLigands == False:
+				combos = self.iterPureCombinations(self.scaffold, 
+										self.binding_list, metal, self.ligands, 
+										self.charges, self.unpaired)
+			else:
+				combos = self.iterMixCombinations(self.scaffold, 
+										self.binding_list, metal, self.ligands,
+										self.charges, self.unpaired)
+			for combo in combos:
+				yield combo
+
+	def iterModes(self, combo_list=None, manifest=None):
+		'''
+		Generator over AbstractModes for each Combination-BindingMode match.  If
+		no combinations are provided, they are pulled lazily from
+		iterCombinations.  The modes are passed through each of self.filters
+		in order.  With an OutputManifest, see resumeModes
+		'''
+		if combo_list is None:
+			combo_list = stats.iterate('combinations', self.iterCombinations())
+
+		if manifest is not None:
+			for mode in self.resumeModes(combo_list, manifest):
+				yield mode
+			return
+
+		modes = stats.iterate('conformers', self.createModes(combo_list))
+		for mode in self.filterModes(modes):
+			yield mode
+
+	def keySettings(self):
+		'''
+		Returns the filters and rotamer sampler whose settings go into
+		OutputManifest keys
+		'''
+		if self.rotamers is None:
+			return self.filters
+		return self.filters + [self.rotamers]
+
+	def resumeScope(self):
+		'''
+		Returns the widest ModeFilter.scope of self.filters, the group of
+		modes resumeModes has to skip or rebuild together
+		'''
+		scopes = ['mode', 'combination', 'metal']
+		return max([getattr(modeFilter, 'scope', 'mode') 
+						for modeFilter in self.filters] or ['mode'], key=scopes.index)
+
+	def filterModes(self, modes):
+		'''
+		Chains the modes through each of self.filters in order
+		'''
+		for modeFilter in self.filters:
+			modes = stats.iterate('filter.' + type(modeFilter).__name__, 
+										modeFilter.filter(modes))
+		return modes
+
+	def resumeModes(self, combo_list, manifest):
+		'''
+		Like iterModes, but Combination-BindingMode pairs whose files are
+		already current in an OutputManifest are not built.  They are yielded
+		in their usual place as ResumedModes, which the writer only counts, so
+		conformer numbering matches a full run.  Built modes carry their
+		manifest key as mode.inputKey, and the ones the filters removed are
+		yielded without conformations, so the writer records them as current
+		too.
+
+		When a filter compares modes with each other (see resumeScope), the
+		pairs of each Combination, or of each metal, are skipped only if all
+		of them are current and are otherwise all built again, so the filter
+		sees the same modes as in a full run.  The key of each pair then also
+		covers the other pairs of its group.  Pairs with the same inputs are
+		told apart by how many came before them
+		'''
+		skipped = collections.deque()
+		repeats = collections.Counter()
+		tags = collections.deque()
+		built = collections.deque()
+		scope = self.resumeScope()
+		if scope == 'mode':
+			group = lambda item: item[0]
+		elif scope == 'combination':
+			group = lambda item: item[1][0]
 		else:
-			self.makeMixCombinations(scaffold, binding_list, metal, ligands,
-											charges, unpaired, combos)
+			group = lambda item: item[1][0].metal.name
+
+		def pending():
+			pairs = enumerate(self.matchingModes(combo_list, self._modes))
+			for _, members in itertools.groupby(pairs, group):
+				members = list(members)
+				keys = [manifest.modeKey(combo, mode, self.scaffold, self.symmetry,
+												self.keySettings()) for _, (combo, mode) in members]
+				if scope != 'mode':
+					keys = manifest.groupKeys(keys)
+				for i, key in enumerate(keys):
+					repeats[key] += 1
+					keys[i] = manifest.repeatKey(key, repeats[key])
+				if all(manifest.isCurrent(key) for key in keys):
+					for (position, (combo, mode)), key in zip(members, keys):
+						skipped.append((position, ResumedMode(key, combo, mode, 
+										self.scaffold, manifest.names(key), self.buildMode)))
+					continue
+				for (position, (combo, mode)), key in zip(members, keys):
+					tags.append((position, key))
+					yield combo, mode
+
+		def tagged(modes):
+			for mode in modes:
+				position, mode.inputKey = tags.popleft()
+				built.append((position, mode))
+				yield mode
+
+		def before(mode):
+			# The skipped modes and the built modes that the filters removed
+			# which come before mode, or all that are left if mode is None
+			while built and built[0][1] is not mode:
+				position, pruned = built.popleft()
+				while skipped and skipped[0][0] < position:
+					yield skipped.popleft()[1]
+				pruned.removeConformations([False]*len(pruned.conformations))
+				yield pruned
+			position = built.popleft()[0] if built else None
+			while skipped and (position is None or skipped[0][0] < position):
+				yield skipped.popleft()[1]
+
+		modes = stats.iterate('conformers', 
+									tagged(self.createModes(None, pending())))
+		for mode in self.filterModes(modes):
+			for earlier in before(mode):
+				yield earlier
+			yield mode
+		for earlier in before(None):
+			yield earlier
+
+	def buildMode(self, combo, binding):
+		'''
+		Builds and filters the AbstractMode of a single pair, returning None if
+		the filters removed all of its conformations
+		'''
+		mixed = len(set(combo.ligands)) > 1
+		modes = [AbstractMode(combo, binding, self.scaffold, mixed=mixed,
+									symmetry=self.symmetry, rotamers=self.rotamers,
+									cache=self.placementCache)]
+		modes = list(self.filterModes(modes))
+		return modes[0] if modes else None
+
+	def createModes(self, combo_list, pairs=None):
+		'''
+		Generator over the AbstractMode of each Combination-BindingMode match,
+		or of each (Combination, BindingMode) in pairs if given, built on a
+		process pool when more than one worker was requested
+		'''
+		if pairs is None:
+			pairs = self.matchingModes(combo_list, self._modes)
+
+		if self.workers is not None and self.workers > 1:
+			for mode in self.createModesParallel(pairs):
+				stats.count('conformersGenerated', len(mode.conformations))
+				yield mode
+			return
 
-		abstractModes = [AbstractMode(combo, mode, scaffold, mixed=False) 
-			for combo, mode in self.matchingModes(self.combinations, self._modes)]
+		for combo, mode in pairs:
+			mixed = len(set(combo.ligands)) > 1
+			absMode = AbstractMode(combo, mode, self.scaffold, mixed=mixed,
+											symmetry=self.symmetry, rotamers=self.rotamers,
+											cache=self.placementCache)
+			stats.count('conformersGenerated', len(absMode.conformations))
+			yield absMode
+
+	def createModesParallel(self, pairs):
+		'''
+		Builds conformations on a pool of self.workers processes.  The
+		scaffold, binding modes (with their ligand placements) and ligands are
+		sent to each worker once through the pool initializer.  Each task is a
+		chunk of compact (metal, charge, unpaired, ligand indices, mode index)
+		tuples and comes back as bare conformations and ligand indices, which
+		are wrapped into AbstractModes here.  Pairs are handled in windows of
+		a few chunks per worker so memory stays bounded, and results are
+		yielded in the same order as the serial path so conformer numbering
+		does not change.
+		'''
+		bindingList = list(self.binding_list)
+		ligIndex = dict((id(lig), i) for i, lig in enumerate(self.ligands))
+		modeIndex = dict((id(mode), i) for i, mode in enumerate(bindingList))
 
-		self.finalModes = abstractModes
+		pool = multiprocessing.Pool(self.workers, _initWorker, 
+								(self.scaffold, bindingList, self.ligands, self.symmetry,
+								self.rotamers))
+		try:
+			window = []
+			windowSize = self.chunksize * self.workers * 2
+			for pair in pairs:
+				window.append(pair)
+				if len(window) == windowSize:
+					for mode in self._runWindow(pool, window, ligIndex, modeIndex):
+						yield mode
+					window = []
+			for mode in self._runWindow(pool, window, ligIndex, modeIndex):
+				yield mode
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+
+	def _runWindow(self, pool, window, lig_index, mode_index):
+		tasks = []
+		for combo, mode in window:
+			tasks.append((combo.metal.name, combo.charge, combo.unpaired,
+								tuple(lig_index[id(lig)] for lig in combo.ligands),
+								mode_index[id(mode)]))
+		chunks = [tasks[i:i+self.chunksize] 
+						for i in range(0, len(tasks), self.chunksize)]
+
+		results = []
+		for chunk, (sampled, pruned) in pool.map(_buildConformers, chunks):
+			results.extend(chunk)
+			if self.rotamers is not None:
+				self.rotamers.addCounts(sampled, pruned)
+
+		for (combo, mode), (conformations, assignments) in zip(window, results):
+			assignments = [[self.ligands[i] for i in ligs] for ligs in assignments]
+			yield AbstractMode.fromConformations(combo, mode, self.scaffold,
+										conformations, assignments, symmetry=self.symmetry,
+										rotamers=self.rotamers)
 
 	def makeModesHashTable(self, binding_modes):
 		'''
 		Returns a hash table consisting of binding modes with the ligand number
 		as the key with values consisting of a list of modes that contain that
-		number of ligands
+		number of ligands.  A BindingModeSet is already bucketed and is used
+		as is
 		'''
+		if isinstance(binding_modes, BindingModeSet):
+			self.maxLigs = max(self.maxLigs, binding_modes.maxLigs)
+			return dict((ligNum, list(modes)) 
+								for ligNum, modes in binding_modes.byLigands.items())
+
 		hashTable = {}
 
 		for mode in binding_modes:
@@ -60,6 +347,71 @@ class Clusterizer(object):
 		
 		return hashTable
 
+	def checkShard(self, shard):
+		if shard is None:
+			return None
+		index, count = shard
+		if count < 1 or not 0 <= index < count:
+			raise ValueError('Shard %s/%s is not one of 0/N to N-1/N' % 
+									(index, count))
+		return (index, count)
+
+	def shardCombinations(self, combo_list, index, count):
+		'''
+		Returns the Combinations of shard index out of count, in their usual
+		order.  Every pair of a Combination stays in the same shard, so the
+		per-Combination conformer numbering of writeAllModes and the
+		DuplicateFilter see exactly what they would in a single run.  Shards
+		are balanced by the estimated number of atoms written (see
+		shardWeights), handing the heaviest Combination left to the lightest
+		shard with ties going to the lower index, so every task computes the
+		same partition without talking to the others
+		'''
+		if count == 1:
+			return list(combo_list)
+		weights = self.shardWeights(combo_list)
+		loads = [(0, shard) for shard in range(count)]
+		owners = [None]*len(combo_list)
+		for i in sorted(range(len(combo_list)), key=lambda i: (-weights[i], i)):
+			load, shard = heapq.heappop(loads)
+			owners[i] = shard
+			heapq.heappush(loads, (load + weights[i], shard))
+		return [combo for combo, owner in zip(combo_list, owners) 
+					if owner == index]
+
+	def shardWeights(self, combo_list):
+		'''
+		Returns the estimated number of atoms written for each Combination: its
+		conformations on every matching binding mode, counted with
+		countAssignments before any filters, times the atoms in each file
+		'''
+		numScaffold = len(self.scaffold.atom_list)
+		conformers = {}
+		structures = {}
+		weights = []
+		for combo in combo_list:
+			pattern = tuple(sorted(collections.Counter(
+										id(lig) for lig in combo.ligands).values()))
+			confs = 0
+			for mode in self._modes.get(combo.getNumLigands(), []):
+				key = (id(mode), pattern)
+				if key not in conformers:
+					conformers[key] = countAssignments(mode, self.scaffold, pattern,
+																	self.symmetry, structures)
+				confs += conformers[key]
+			atoms = numScaffold + 1 + sum(len(lig.atom_list) for lig in combo.ligands)
+			weights.append(confs*atoms)
+		return weights
+
+	def combinationKey(self):
+		'''
+		Returns a hashable key of everything besides the metals and ligands
+		that decides which combinations are allowed: the (charge, unpaired
+		parity) targets and the ligand numbers of the binding modes.
+		Scaffolds with equal keys share the same combinations
+		'''
+		return (tuple(self._targets), tuple(sorted(self._modes)))
+
 	def makeChargesHashTable(self, scaffold, charges, unpaireds):
 		hashTable = {}
 		for charge, unpaired in zip(charges, unpaireds):
@@ -67,68 +419,256 @@ class Clusterizer(object):
 			hashTable[charge] = unpaired
 		return hashTable
 
+	def makeTargets(self, scaffold):
+		'''
+		Returns the sorted list of (charge, unpaired parity) targets that a
+		metal-ligand combination must reach to satisfy self._cCharges once the
+		scaffold is accounted for
+		'''
+		targets = set()
+		for cCharge, unpaireds in self._cCharges.items():
+			for unpaired in unpaireds:
+				targets.add((cCharge, (unpaired - scaffold.unpaired) % 2))
+		return sorted(targets)
+
+	def makeChargeIndex(self, metals, ligands):
+		'''
+		Returns a ChargeIndex of every pure ligand solution for the counter
+		charges in self._cCharges, built once for all metal oxidation states
+		'''
+		metalStates = set()
+		for metal in metals:
+			for charge in metal.charge:
+				for unpaired in metal.unpaired:
+					metalStates.add((charge, unpaired))
+
+		return ChargeIndex(self._targets, set(self._modes), 
+									sorted(metalStates), ligands)
+
 	def makePureCombinations(self, scaffold, binding_list, metal, ligands, 
 									charge, unpaired):
 		'''
+		Accumulates the pure ligand combinations of a metal into
+		self.combinations.  See iterPureCombinations
+		'''
+		self.combinations.extend(self.iterPureCombinations(scaffold, 
+									binding_list, metal, ligands, charge, unpaired))
+
+	def iterPureCombinations(self, scaffold, binding_list, metal, ligands, 
+									charge, unpaired):
+		'''
 		Since we're only specifying pure ligand combinations, we can use
-		simple math to construct combinations
+		simple math to construct combinations.  Yields each new Combination as
+		soon as it is found
 		'''
 		prevCombos = {}
+		ligands = set(ligands)
+
+		# Every (metal state, ligand state, count) that balances a target
+		# charge is already in the ChargeIndex, so this is only lookups
+		for metalCharge in sorted(metal.charge):
+			for metalUnpaired in sorted(metal.unpaired):
+				for target in self._chargeIndex.targets:
+					solutions = self._chargeIndex.lookup(target, metalCharge,
+																		metalUnpaired)
+					for lig, ligCharge, ligUnpaired, ligsToAdd in solutions:
+						if lig is not None and lig not in ligands:
+							continue
+						newCombo = Combination()
+						newCombo.addMetal(metal, metalCharge, metalUnpaired)
+						if ligsToAdd > 0:
+							newCombo = self.addLigs(newCombo, lig, ligsToAdd, 
+															ligCharge, ligUnpaired)
+						stats.count('combinationsTried')
+						if not self.isPrevCombo(newCombo, prevCombos):
+							stats.count('combinationsAccepted')
+							yield newCombo
+							prevCombos = self.addToComboDict(newCombo, prevCombos)
+						else:
+							stats.count('combinationsDeduped')
 
-		# This needs to be refactored ASAP because it reads like ass.  Maybe
-		# implement a method object or some other abstract concept.  Maybe a
-		# generator would be a good fit.  Maybe just break into smaller methods
-		# Note: this is not yet handling counter radicals like it should in the
-		# _cCharge dict
-		for metalCharge in metal.charge:
-			for metalUnpaired in metal.unpaired:
-				for lig in ligands:
-					newCombo = Combination()
-					newCombo.addMetal(metal, metalCharge, metalUnpaired)
-					if not self.isPrevCombo(newCombo, prevCombos):
-						if (self.isCounterCharge(newCombo) and
-								newCombo.getNumLigands() in self._modes):
-							self.combinations.append(newCombo)
-					prevCombos = self.addToComboDict(newCombo, prevCombos)
-					for charge in lig.charge:
-						for cCharge in self._cCharges:
-							tmpCombo = None
-							ligsToAdd = (newCombo.charge - cCharge) / (-charge)
-							if (ligsToAdd > 0 and ligsToAdd in self._modes):
-								tmpCombo = self.addLigs(newCombo, lig, ligsToAdd)
-								if not self.isPrevCombo(tmpCombo, prevCombos):
-									self.combinations.append(tmpCombo)
-									prevCombos = self.addToComboDict(tmpCombo, 
-																				prevCombos)
-
-	
 	def isCounterCharge(self, combination):
 		if combination.charge in self._cCharges:
 			return True
 		return False
 
 	def isPrevCombo(self, combination, combo_dict):
-		if combination._hashval in combo_dict:
+		if combination in combo_dict:
 			return True
 		return False
 
 	def addToComboDict(self, combination, combo_dict):
-		combo_dict[combination._hashval] = combination
+		combo_dict[combination] = combination
 		return combo_dict
 
-	def addLigs(self, combination, ligand, numToAdd):
-		for _ in range(numToAdd):
-			# Note: change ligand class to only have one charge and one 
-			# unpaired.  Otherwise is overcomplicated
+	def addLigs(self, combination, ligand, numToAdd, charge=None, unpaired=None):
+		# Note: change ligand class to only have one charge and one 
+		# unpaired.  Otherwise is overcomplicated
+		if charge == None:
 			charge = list(ligand.charge)[0]
+		if unpaired == None:
 			unpaired = list(ligand.unpaired)[0]
+		for _ in range(numToAdd):
 			combination.addLigand(ligand, charge, unpaired)
 		return combination
 
 	def makeMixCombinations(self, scaffold, binding_list, metal, ligands,
 									charge, unpaired):
-		print("Mixed combinations not implemented yet!")
-		sys.exit()
+		'''
+		Accumulates the mixed ligand combinations of a metal into
+		self.combinations.  See iterMixCombinations
+		'''
+		self.combinations.extend(self.iterMixCombinations(scaffold, 
+									binding_list, metal, ligands, charge, unpaired))
+
+	def iterMixCombinations(self, scaffold, binding_list, metal, ligands,
+									charge, unpaired):
+		'''
+		Yields every combination of a metal with a multiset of ligands, pure
+		sets included, that reaches a counter charge with a ligand number in
+		the modes hash table.  The multisets come from the LigandKnapsack, so
+		only charge-feasible partial sets are ever expanded
+		'''
+		prevCombos = {}
+		ligands = set(ligands)
+
+		for metalCharge in sorted(metal.charge):
+			for metalUnpaired in sorted(metal.unpaired):
+				for ligSet in self._knapsack.solutions(metalCharge, metalUnpaired):
+					if any(lig not in ligands for lig, _, _, _ in ligSet):
+						continue
+					newCombo = Combination()
+					newCombo.addMetal(metal, metalCharge, metalUnpaired)
+					for lig, ligCharge, ligUnpaired, ligsToAdd in ligSet:
+						newCombo = self.addLigs(newCombo, lig, ligsToAdd, 
+														ligCharge, ligUnpaired)
+					stats.count('combinationsTried')
+					if not self.isPrevCombo(newCombo, prevCombos):
+						stats.count('combinationsAccepted')
+						yield newCombo
+						prevCombos = self.addToComboDict(newCombo, prevCombos)
+					else:
+						stats.count('combinationsDeduped')
+
+	def countMixCombinations(self, metals=None):
+		'''
+		Returns a dict of metal name to the number of mixed ligand combinations
+		the metal will produce, counted without building any of them
+		'''
+		if metals is None:
+			metals = self.metals
+
+		counts = {}
+		for metal in metals:
+			total = self._knapsack.count([(charge, unpaired) 
+							for charge in metal.charge for unpaired in metal.unpaired])
+			counts[metal.name] = counts.get(metal.name, 0) + total
+		return counts
+
+	def tallyCombinations(self, metal):
+		'''
+		Yields (pattern, rotor states, [combinations, ligand atoms, ligand name
+		length]) for every group of combinations a metal will produce, where
+		pattern holds the count of each distinct ligand and rotor states is
+		the number of rotamer states of each conformation (see
+		LigandKnapsack.setRotamers).  Nothing is built; mixed sets come from
+		LigandKnapsack.tally and pure sets from the ChargeIndex.  Like the
+		Clusterizer, Combinations reached from several metal or ligand states
+		are counted once
+		'''
+		if self.mixLigands:
+			tallies = self._knapsack.tally([(charge, unpaired) 
+							for charge in metal.charge for unpaired in metal.unpaired])
+			for (pattern, states), tally in sorted(tallies.items()):
+				yield pattern, states, tally
+			return
+
+		ligands = set(self.ligands)
+		seen = set()
+		for metalCharge in sorted(metal.charge):
+			for metalUnpaired in sorted(metal.unpaired):
+				for target in self._chargeIndex.targets:
+					solutions = self._chargeIndex.lookup(target, metalCharge,
+																		metalUnpaired)
+					for lig, _, _, ligsToAdd in solutions:
+						if lig is not None and lig not in ligands:
+							continue
+						if (lig, ligsToAdd, target) in seen:
+							continue
+						seen.add((lig, ligsToAdd, target))
+						if ligsToAdd == 0:
+							yield (), 1, [1, 0, 0]
+						else:
+							states = self._knapsack.rotorStates(lig, ligsToAdd)
+							yield (ligsToAdd,), states, [1, 
+									ligsToAdd*len(lig.atom_list), ligsToAdd*len(lig.name)]
+
+	def estimateOutput(self, output=None, header=None, footer=None,
+								block_size=4096):
+		'''
+		Dry run of getFinalModes followed by G09Output.writeAllModes.  Counts
+		the combinations, files and bytes a screen will produce, per metal and
+		per ligand number bucket of the binding modes, without building any
+		Combination or conformation.  Combinations are counted by pattern (see
+		tallyCombinations) and the conformations of each pattern on each
+		binding mode are counted once, see countAssignments.  File sizes come from the rendered
+		scaffold block and its average line length, and diskBytes rounds each
+		file up to block_size.  Filters are not applied, so these are upper
+		bounds when filters are used.  Combinations are counted exactly, also
+		when ligands have several charge or spin states.
+		With a RotamerSampler every conformation counts as all of its rotor
+		states, at most max_states, before any are pruned for clashes, so
+		these are upper bounds too.
+		'''
+		if output is None:
+			output = G09Output('.')
+		if header is None:
+			header = self.scaffold.head_lines
+		scaffoldBytes = len(output.scaffoldBlock(self.scaffold))
+		lineBytes = scaffoldBytes / float(max(len(self.scaffold.atom_list), 1))
+		chargeLine = max([len('%d 1\n' % (target[0] + self.scaffold.charge)) 
+									for target in self._targets] or [4])
+		fixed = len('%chk=_charge0_1et_conf1.chk\n') + len(header.rstrip('\n')) + \
+					1 + len('\n%s\n\n' % output.title) + \
+					chargeLine + scaffoldBytes + 1 + len(footer or '') + 3
+
+		estimate = {'files': 0, 'bytes': 0, 'diskBytes': 0, 'metals': {}, 
+						'buckets': {}}
+		conformers = {}
+		structures = {}
+		for metal in self.metals:
+			perMetal = estimate['metals'].setdefault(metal.name, {'combinations': 0,
+									'files': 0, 'bytes': 0, 'diskBytes': 0})
+			for pattern, states, tally in self.tallyCombinations(metal):
+				num, atoms, names = tally
+				ligNum = sum(pattern)
+				modes = self._modes.get(ligNum, [])
+				bucket = estimate['buckets'].setdefault(ligNum, {'combinations': 0,
+									'modes': len(modes), 'files': 0, 'bytes': 0, 
+									'diskBytes': 0})
+				# Bytes summed over every combination of the group, per conformer
+				groupBytes = num*(fixed + len(metal.name) + lineBytes) + \
+									atoms*lineBytes + names
+				confs = 0
+				for mode in modes:
+					key = (id(mode), pattern)
+					if key not in conformers:
+						conformers[key] = countAssignments(mode, self.scaffold, pattern,
+																		self.symmetry, structures)
+					confs += conformers[key]
+				confs *= states
+				files = num*confs
+				size = int(round(confs*groupBytes))
+				disk = 0
+				if files:
+					disk = files*block_size*int(-(-size // (files*block_size)))
+				for totals in (estimate, perMetal, bucket):
+					totals['files'] += files
+					totals['bytes'] += size
+					totals['diskBytes'] += disk
+				perMetal['combinations'] += num
+				bucket['combinations'] += num
+		return estimate
 
 	def matchingModes(self, combo_list, modes_list):
 		for combo in combo_list:
@@ -137,5 +677,467 @@ class Clusterizer(object):
 				yield combo, mode
 
 	def getFinalModes(self):
+		'''
+		Returns a ConformerStore holding every mode, or a fresh generator over
+		AbstractModes when the Clusterizer was created with lazy=True
+		'''
+		if self.lazy == True:
+			return self.iterModes()
 		return self.finalModes
 
+
+# Shared state of a conformer worker process, set once by _initWorker
+_worker = {}
+
+def _initWorker(scaffold, binding_list, ligands, symmetry, rotamers):
+	_worker['scaffold'] = scaffold
+	_worker['modes'] = binding_list
+	_worker['ligands'] = ligands
+	_worker['ligIndex'] = dict((id(lig), i) for i, lig in enumerate(ligands))
+	_worker['symmetry'] = symmetry
+	_worker['rotamers'] = rotamers
+	_worker['cache'] = PlacementCache()
+
+def _buildConformers(tasks):
+	'''
+	Builds the conformations for a chunk of compact tasks in a worker.  The
+	rebuilt Combination carries the whole charge on the metal, which makes it
+	equal to the original without needing each ligand's charge.  Returns the
+	results with the (sampled, pruned) rotamer counts of the chunk, since the
+	worker's RotamerSampler is only a copy
+	'''
+	ligands = _worker['ligands']
+	rotamers = _worker['rotamers']
+	if rotamers is not None:
+		before = (rotamers.sampled, rotamers.pruned)
+	results = []
+	for metalName, charge, unpaired, ligIndices, modeIndex in tasks:
+		combo = Combination()
+		combo.addMetal(Metal(metalName, [charge], [unpaired]), charge, unpaired)
+		for i in ligIndices:
+			combo.addLigand(ligands[i], 0, 0)
+		mixed = len(set(ligIndices)) > 1
+		mode = AbstractMode(combo, _worker['modes'][modeIndex], 
+									_worker['scaffold'], mixed=mixed, 
+									symmetry=_worker['symmetry'], 
+									rotamers=_worker['rotamers'], 
+									cache=_worker['cache'])
+		assignments = [[_worker['ligIndex'][id(lig)] for lig in ligs] 
+								for ligs in mode.assignments]
+		results.append((mode.conformations, assignments))
+	if rotamers is None:
+		return results, (0, 0)
+	return results, (rotamers.sampled - before[0], rotamers.pruned - before[1])
+
+class BatchClusterizer(object):
+	'''
+	Screens one metal/ligand set against many scaffolds, each with its own
+	binding modes, given as a list of (scaffold, binding_list) pairs.  A
+	Clusterizer is set up for each scaffold, but the allowed combinations
+	are enumerated only once for each distinct combinationKey, since
+	scaffolds that differ in nothing but the Al placement usually share
+	their charge, spin and ligand numbers.
+
+	run() fans the scaffolds out over a pool of worker processes, writing
+	each one into a subdirectory named after its scaffold file, and writes a
+	combined summary.json.  filters, if given, is a function of the scaffold
+	returning that scaffold's list of ModeFilters.  It has to be picklable,
+	e.g. a module level function, when workers is set
+	'''
+	def __init__(self, scaffolds, metals, ligands, charges=[0], 
+					unpaired=[[0]], mix_ligands=True, symmetry=True, filters=None,
+					workers=None, names=None, rotamers=None):
+		self.metals = metals
+		self.ligands = ligands
+		self.workers = workers
+		self.names = names or self.makeNames([pair[0] for pair in scaffolds])
+		if len(set(self.names)) != len(self.names):
+			raise ValueError('Scaffold names must be unique')
+
+		self.clusterizers = []
+		self.tables = {}
+		self.keys = []
+		for scaffold, binding_list in scaffolds:
+			clusterizer = Clusterizer(scaffold, binding_list, metals, ligands,
+									charges=charges, unpaired=unpaired, 
+									mix_ligands=mix_ligands, lazy=True, symmetry=symmetry,
+									filters=filters(scaffold) if filters else None,
+									rotamers=rotamers)
+			key = clusterizer.combinationKey()
+			if key not in self.tables:
+				self.tables[key] = list(clusterizer.iterAllCombinations())
+			clusterizer.sharedCombinations = self.tables[key]
+			self.clusterizers.append(clusterizer)
+			self.keys.append(key)
+
+	def makeNames(self, scaffolds):
+		'''
+		Names each scaffold after its file, prefixed with the parent directory
+		when file names repeat, and then numbered if they still do
+		'''
+		paths = [scaffold.getLoc() for scaffold in scaffolds]
+		bases = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+		names = []
+		for path, base in zip(paths, bases):
+			if bases.count(base) > 1:
+				base = '%s_%s' % (os.path.basename(os.path.dirname(path)), base)
+			name, i = base, 2
+			while name in names:
+				name = '%s_%d' % (base, i)
+				i += 1
+			names.append(name)
+		return names
+
+	def run(self, directory, header=None, footer=None, makedirs=False,
+				writers=0, summary='summary.json'):
+		'''
+		Writes every scaffold's conformations into directory/<name> and
+		returns the combined summary, which is also saved as summary in
+		directory.  A scaffold that fails is recorded with its error instead
+		of stopping the batch
+		'''
+		start = time.time()
+		directory = os.path.abspath(directory)
+		tasks = [(name, clusterizer, os.path.join(directory, name), header, 
+					footer, makedirs, writers) 
+					for name, clusterizer in zip(self.names, self.clusterizers)]
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		if self.workers:
+			# Worker processes are daemonic and can't have pools of their own
+			for clusterizer in self.clusterizers:
+				clusterizer.workers = None
+			pool = multiprocessing.Pool(self.workers)
+			try:
+				results = list(pool.imap(_screenScaffold, tasks, chunksize=1))
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results = [_screenScaffold(task) for task in tasks]
+
+		tableIds = dict((key, i) for i, key in enumerate(sorted(self.tables)))
+		for result, key in zip(results, self.keys):
+			result['table'] = tableIds[key]
+
+		report = {'scaffolds': results,
+					'tables': len(self.tables),
+					'combinations': sum(r['combinations'] for r in results),
+					'files': sum(r['files'] for r in results),
+					'errors': sum(1 for r in results if r['error']),
+					'seconds': time.time() - start}
+		if summary:
+			with open(os.path.join(directory, summary), 'w') as outfile:
+				json.dump(report, outfile, indent=1, sort_keys=True)
+		return report
+
+def _screenScaffold(task):
+	'''
+	Writes one scaffold of a BatchClusterizer, returning its summary
+	'''
+	name, clusterizer, directory, header, footer, makedirs, writers = task
+	scaffold = clusterizer.scaffold
+	result = {'name': name, 'scaffold': scaffold.getLoc(), 
+				'charge': scaffold.charge, 'unpaired': scaffold.unpaired,
+				'bindingModes': sum(len(modes) for modes in 
+											clusterizer._modes.values()),
+				'combinations': len(clusterizer.sharedCombinations),
+				'modes': 0, 'files': 0, 'error': None}
+	start = time.time()
+
+	def counted(modes):
+		for mode in modes:
+			result['modes'] += 1
+			result['files'] += len(mode.conformations)
+			yield mode
+
+	try:
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		with G09Output(directory, writers=writers) as output:
+			output.writeAllModes(counted(clusterizer.getFinalModes()), header,
+										footer, makedirs)
+	except Exception as error:
+		result['error'] = '%s: %s' % (type(error).__name__, error)
+	result['filters'] = dict((type(f).__name__, f.report()) 
+									for f in clusterizer.filters)
+	result['seconds'] = time.time() - start
+	return result
+
+
+class ChargeIndex(object):
+	'''
+	A precomputed index of the pure ligand charge balance.  For each target
+	(net charge, unpaired parity) of the metal-ligand complex it holds every
+	metal state (charge, unpaired) that can reach the target, together with
+	the ligand, ligand state and integer number of ligands required.  Only
+	ligand numbers present in the binding mode hash table are kept, so every
+	solution has at least one matching BindingMode.  Bare metals are stored
+	once with a ligand of None and a count of 0.
+	'''
+	def __init__(self, targets, ligand_nums, metal_states, ligands):
+		self.targets = list(targets)
+		self._index = {}
+
+		ligStates = []
+		for lig in ligands:
+			for charge in sorted(lig.charge):
+				for unpaired in sorted(lig.unpaired):
+					ligStates.append((lig, charge, unpaired))
+
+		for target in self.targets:
+			byMetal = {}
+			for metalState in metal_states:
+				solutions = self.solve(target, metalState, ligStates, ligand_nums)
+				if solutions:
+					byMetal[metalState] = solutions
+			self._index[target] = byMetal
+
+	def solve(self, target, metal_state, lig_states, ligand_nums):
+		'''
+		Returns the list of (ligand, charge, unpaired, count) solutions that
+		bring a metal state to the target charge and unpaired parity
+		'''
+		netCharge, netUnpaired = target
+		metalCharge, metalUnpaired = metal_state
+		diff = netCharge - metalCharge
+		solutions = []
+
+		if diff == 0 and metalUnpaired % 2 == netUnpaired and 0 in ligand_nums:
+			solutions.append((None, None, None, 0))
+
+		for lig, charge, unpaired in lig_states:
+			if charge == 0:
+				# Neutral ligands never change the charge, so any count works
+				counts = sorted(n for n in ligand_nums if n > 0) if diff == 0 else []
+			else:
+				# Integer division keeps counts matching the _modes keys
+				count, remainder = divmod(diff, charge)
+				counts = [count] if remainder == 0 and count > 0 else []
+
+			for count in counts:
+				if (count in ligand_nums and 
+						(metalUnpaired + count*unpaired) % 2 == netUnpaired):
+					solutions.append((lig, charge, unpaired, count))
+
+		return solutions
+
+	def lookup(self, target, metal_charge, metal_unpaired):
+		'''
+		Returns the solutions for a metal state at the given target, or an
+		empty list if it cannot be balanced
+		'''
+		return self._index.get(target, {}).get((metal_charge, metal_unpaired), [])
+
+
+class LigandKnapsack(object):
+	'''
+	Bounded knapsack over ligand multisets for mixed ligand combinations.
+
+	Ligand states (ligand, charge, unpaired) are considered in a fixed order
+	and a multiset is built by choosing how many of each to add.  A partial
+	set is summarized by the state (ligand number, net charge, unpaired
+	parity), starting from the metal's charge and parity.  Working backwards
+	from the goal states (a ligand number in the modes hash table at a target
+	charge and parity), _feasible[i] holds every state from which a goal is
+	still reachable using ligand states i onwards.  Enumeration and counting
+	only step into states in that table, so no partial set that cannot be
+	charge balanced is ever expanded, and no set exceeds maxLigs.
+
+	Multisets that differ only in the charge or spin states of a ligand can
+	end in the same Combination, which the Clusterizer makes only once.
+	Counting therefore works a whole ligand at a time on the set of states
+	its copies can reach, from every metal state at once, so each distinct
+	number of each ligand at each net charge and parity is counted once.
+	'''
+	def __init__(self, targets, ligand_nums, ligands, max_ligs):
+		self.maxLigs = max_ligs
+		self.ligStates = []
+		for lig in ligands:
+			for charge in sorted(lig.charge):
+				for unpaired in sorted(lig.unpaired):
+					if (lig, charge, unpaired) not in self.ligStates:
+						self.ligStates.append((lig, charge, unpaired))
+
+		self._goals = set()
+		for ligNum in ligand_nums:
+			if ligNum <= max_ligs:
+				for charge, unpaired in targets:
+					self._goals.add((ligNum, charge, unpaired))
+
+		self._feasible = self.makeFeasibleStates()
+		# The states of one ligand are adjacent; _ligStart[j] is the index of
+		# the first state of ligand j
+		self._ligands = []
+		self._ligStart = []
+		for i, (lig, _, _) in enumerate(self.ligStates):
+			if not self._ligands or self._ligands[-1] is not lig:
+				self._ligands.append(lig)
+				self._ligStart.append(i)
+		self._ligStart.append(len(self.ligStates))
+		self._deltas = [self.makeDeltas(self.ligStates[start:end]) for start, end
+								in zip(self._ligStart, self._ligStart[1:])]
+		self._counts = {}
+		self._tallies = {}
+		self.rotamers = {}
+		self.maxStates = None
+
+	def setRotamers(self, counts, max_states):
+		'''
+		Makes tally count the rotor states of each multiset's conformations,
+		the product of its ligands' rotamer counts, given as a dict of ligand
+		to count, but no more than max_states
+		'''
+		self.rotamers = counts
+		self.maxStates = max_states
+		self._tallies = {}
+
+	def rotorStates(self, lig, num, states=1):
+		'''
+		Returns states times the rotor states of num of a ligand, capped at
+		self.maxStates
+		'''
+		states *= self.rotamers.get(lig, 1)**num
+		if self.maxStates is not None:
+			states = min(states, self.maxStates)
+		return states
+
+	def makeFeasibleStates(self):
+		'''
+		Returns the list of feasible state sets, one per ligand state plus the
+		final goal set
+		'''
+		feasible = [None]*len(self.ligStates) + [self._goals]
+		for i in reversed(range(len(self.ligStates))):
+			_, charge, unpaired = self.ligStates[i]
+			states = set()
+			for ligNum, netCharge, netUnpaired in feasible[i+1]:
+				for k in range(ligNum+1):
+					states.add((ligNum - k, netCharge - k*charge, 
+									(netUnpaired - k*unpaired) % 2))
+			feasible[i] = states
+		return feasible
+
+	def makeDeltas(self, states):
+		'''
+		Returns, for each number k up to maxLigs, the set of (charge, unpaired
+		parity) that k ligands in the given ligand states can add
+		'''
+		deltas = [set([(0, 0)])]
+		for _ in range(self.maxLigs):
+			deltas.append(set((charge + ligCharge, (unpaired + ligUnpaired) % 2)
+									for charge, unpaired in deltas[-1]
+									for _, ligCharge, ligUnpaired in states))
+		return deltas
+
+	def _step(self, i, state):
+		'''
+		Yields (count, new state) for every number of ligand state i that can
+		be added to state while remaining feasible
+		'''
+		_, charge, unpaired = self.ligStates[i]
+		ligNum, netCharge, netUnpaired = state
+		for k in range(self.maxLigs - ligNum + 1):
+			newState = (ligNum + k, netCharge + k*charge, 
+								(netUnpaired + k*unpaired) % 2)
+			if newState in self._feasible[i+1]:
+				yield k, newState
+
+	def _ligandStep(self, j, states):
+		'''
+		Yields (count, new states) for every number of ligand j that can be
+		added to a set of states with some of them remaining feasible
+		'''
+		feasible = self._feasible[self._ligStart[j+1]]
+		fewest = min(ligNum for ligNum, _, _ in states)
+		for k in range(self.maxLigs - fewest + 1):
+			newStates = frozenset(newState for newState in 
+									((ligNum + k, netCharge + charge, (netUnpaired + unpaired) % 2)
+									for ligNum, netCharge, netUnpaired in states
+									for charge, unpaired in self._deltas[j][k])
+									if newState in feasible)
+			if newStates:
+				yield k, newStates
+
+	def _startStates(self, metal_states):
+		return frozenset((0, charge, unpaired % 2) for charge, unpaired in 
+								metal_states) & frozenset(self._feasible[0])
+
+	def count(self, metal_states):
+		'''
+		Returns the number of distinct Combinations that balance a metal in
+		any of its (charge, unpaired) metal_states
+		'''
+		states = self._startStates(metal_states)
+		if not states:
+			return 0
+		return self._countFrom(0, states)
+
+	def _countFrom(self, j, states):
+		if j == len(self._ligands):
+			return len(states)
+		key = (j, states)
+		if key not in self._counts:
+			self._counts[key] = sum(self._countFrom(j+1, newStates)
+											for _, newStates in self._ligandStep(j, states))
+		return self._counts[key]
+
+	def tally(self, metal_states):
+		'''
+		Counts the distinct Combinations that balance a metal in any of its
+		(charge, unpaired) metal_states by pattern, the descending tuple of how
+		many of each distinct ligand a Combination holds, and rotor states (see
+		setRotamers).  Returns a dict of (pattern, rotor states) to
+		[Combinations, total ligand atoms, total length of the ligand names],
+		summed over the Combinations, without building any of them
+		'''
+		states = self._startStates(metal_states)
+		if not states:
+			return {}
+		return self._tallyFrom(0, states)
+
+	def _tallyFrom(self, j, states):
+		if j == len(self._ligands):
+			return {((), 1): [len(states), 0, 0]}
+		key = (j, states)
+		if key in self._tallies:
+			return self._tallies[key]
+
+		lig = self._ligands[j]
+		tallies = {}
+		for k, newStates in self._ligandStep(j, states):
+			rest = self._tallyFrom(j+1, newStates)
+			for (pattern, rotors), (num, atoms, names) in rest.items():
+				if k > 0:
+					pattern = tuple(sorted(pattern + (k,), reverse=True))
+				rotors = self.rotorStates(lig, k, rotors)
+				total = tallies.setdefault((pattern, rotors), [0, 0, 0])
+				total[0] += num
+				total[1] += atoms + k*len(lig.atom_list)*num
+				total[2] += names + k*len(lig.name)*num
+		self._tallies[key] = tallies
+		return tallies
+
+	def solutions(self, metal_charge, metal_unpaired):
+		'''
+		Yields each ligand multiset that balances a metal state as a list of
+		(ligand, charge, unpaired, count) tuples with nonzero counts
+		'''
+		state = (0, metal_charge, metal_unpaired % 2)
+		if state not in self._feasible[0]:
+			return
+		for ligSet in self._expand(0, state):
+			yield ligSet
+
+	def _expand(self, i, state):
+		if i == len(self.ligStates):
+			yield []
+			return
+		lig, charge, unpaired = self.ligStates[i]
+		for k, newState in self._step(i, state):
+			for rest in self._expand(i+1, newState):
+				if k > 0:
+					yield [(lig, charge, unpaired, k)] + rest
+				else:
+					yield rest
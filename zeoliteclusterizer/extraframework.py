@@ -1,5 +1,6 @@
 import sys
 import string
+from atoms import AtomTable
 
 class Properties(object):
 	'''
@@ -35,6 +36,7 @@ class Ligand(Metal):
 
 	atom_list should consist of a string and three numbers, e.g.:
 		[['H', 0.0, 0.0, 1.0], ...]
+	and is stored as an AtomTable
 	'''
 	def __init__(self, name, atom_list, charges, unpaired, 
 						headInd=0, tailInd=None):
@@ -61,18 +63,11 @@ class Ligand(Metal):
 		It is conceivable that a user might read in coordinates from a file,
 		thus it's important that the resulting strings be converted into floats
 		to maintain the ability to easily transform coordinates, and control
-		final output printing
+		final output printing.  Returns an AtomTable with every atom unfrozen
 		'''
-		newList = []
-		for element in atom_list:
-			# Want to ignore elemental string and examine rest
-			tmp = [element[0]]
-			for i in range(1, 4):
-				element[i] = float(element[i])
-				tmp.append(element[i])
-			newList.append(tmp)
-
-		return newList
+		if isinstance(atom_list, AtomTable):
+			return atom_list.copy()
+		return AtomTable.fromRows(atom_list)
 
 	def setHead(self, index):
 		'''
@@ -103,14 +98,43 @@ class Ligand(Metal):
 	def getTailIndex(self):
 		return self._tailIndex 
 
+	def getAxis(self):
+		'''
+		Returns the head to tail vector used to orient the ligand.  Zero for
+		single atom ligands
+		'''
+		coords = self.atom_list.coords
+		return coords[self._tailIndex] - coords[self._headIndex]
+
+	def getLocalCoords(self):
+		'''
+		Returns the ligand coordinates with the head atom at the origin
+		'''
+		coords = self.atom_list.coords
+		return coords - coords[self._headIndex]
+
 class Combination(object):
 	'''
+	A metal and the ligands bound to it, along with the net charge and
+	unpaired electron parity.  Combinations compare equal when they hold the
+	same multiset of species at the same charge and parity, regardless of
+	the order things were added in, so they can be used directly as dict keys
+	for deduplication.  The charge state each ligand was added in is kept,
+	in the same order, in ligandCharges.  The order ignorant hash is updated
+	in O(1) per added species by summing the hashes of the species names.  A
+	Combination should not be modified once it has been used as a key.
+	Slotted, since a large screen keeps a great many of them alive.
 	'''
+	__slots__ = ('metal', 'ligands', 'ligandCharges', '_counts', '_speciesHash',
+						'_name', 'charge', 'unpaired')
+
 	def __init__(self):
 		self.metal = None
 		self.ligands = []
-		self._hashval = None
-		self._strings = []
+		self.ligandCharges = []
+		self._counts = {}
+		self._speciesHash = 0
+		self._name = None
 		self.charge = 0
 		self.unpaired = 0
 
@@ -126,29 +150,58 @@ class Combination(object):
 
 	def addMetal(self, metal, charge, unpaired):
 		self.metal = metal
-		self._strings.append(metal.name)
+		self.addSpecies(metal.name)
 		self.updateHashVal(charge, unpaired)
 
 	def addLigand(self, lig, charge, unpaired):
 		self.ligands.append(lig)
-		self._strings.append(lig.name)
+		self.ligandCharges.append(charge)
+		self.addSpecies(lig.name)
 		self.updateHashVal(charge, unpaired)
 
+	def addSpecies(self, name):
+		self._counts[name] = self._counts.get(name, 0) + 1
+		self._speciesHash = (self._speciesHash + hash(name)) & 0xFFFFFFFFFFFFFFFF
+		self._name = None
+
 	def updateHashVal(self, charge, unpaired):
-		# Implement binary insertion at some point or implement custom char
-		# order ignorant hashing scheme (e.g. h = sum(c*x^2)) to avoid the
-		# O(n log n) sort and O(n) join
 		self.updateElectrons(charge, unpaired)
-		self._strings = sorted(self._strings)
-		tmp = [ string for string in self._strings ]
-		tmp.append( '(%d)(%d)' % (self.charge, self.unpaired))
-		self._hashval = ''.join(tmp)
-		#self._hashval = self._hashval.join(tmp)
 
 	def updateElectrons(self, charge, unpaired):
 		self.charge += charge
 		self.unpaired = (self.unpaired + unpaired) % 2
 
+	def getName(self):
+		'''
+		Returns the species names sorted and joined, as used for output file
+		names.  Only built when asked for
+		'''
+		if self._name is None:
+			self._name = ''.join(name*self._counts[name] 
+										for name in sorted(self._counts))
+		return self._name
+
+	@property
+	def _hashval(self):
+		return self.getName() + '(%d)(%d)' % (self.charge, self.unpaired)
+
+	def __hash__(self):
+		return hash((self._speciesHash, self.charge, self.unpaired))
+
+	def __eq__(self, other):
+		if not isinstance(other, Combination):
+			return NotImplemented
+		return (self._speciesHash == other._speciesHash and
+					self.charge == other.charge and
+					self.unpaired == other.unpaired and
+					self._counts == other._counts)
+
+	def __ne__(self, other):
+		result = self.__eq__(other)
+		if result is NotImplemented:
+			return result
+		return not result
+
 	def getNumLigands(self):
 		return len(self.ligands)
 	
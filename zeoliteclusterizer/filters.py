@@ -0,0 +1,422 @@
+from abc import ABCMeta, abstractmethod
+import numpy as np
+from atoms import covalent_radii, covalentRadii, default_radius, elementSymbol
+from geometry import CellList, matchedRMSD
+from instrument import stats
+
+# Coulomb's constant in kcal/mol angstrom per squared elementary charge
+coulomb = 332.0637
+
+# Partial charges of scaffold atoms, after the ClayFF force field.  H is the
+# hydroxyl hydrogen; Si-H caps are balanced by ScoreFilter.partialCharges
+default_charges = {'Si': 2.1, 'Al': 1.575, 'O': -1.05, 'H': 0.425}
+
+class ModeFilter(object):
+	'''
+	Abstract base class for pipeline stages that prune AbstractModes or their
+	conformations before they are written.  A filter is a generator over
+	modes, so it can sit anywhere between the Clusterizer and the writer,
+	either through Clusterizer(filters=[...]) or by wrapping the modes handed
+	to writeAllModes.
+
+	scope is the widest group of modes whose outcome one mode can depend on:
+	'mode' for filters that look at each mode on its own, 'combination' or
+	'metal' for ones that compare modes across such a group.  Resumed runs
+	skip or rebuild whole groups, see Clusterizer.resumeModes
+	'''
+
+	__metaclass__ = ABCMeta
+
+	scope = 'mode'
+
+	@abstractmethod
+	def filter(self, absModes):
+		'''Yield the modes that survive, with pruned conformations removed'''
+		pass
+
+	@abstractmethod
+	def report(self):
+		'''Return a dict of counts describing what was pruned'''
+		pass
+
+	def settings(self):
+		'''
+		Returns a tuple of the parameters that decide what is pruned, used in
+		OutputManifest keys
+		'''
+		return (type(self).__name__,)
+
+class ClashFilter(ModeFilter):
+	'''
+	Removes conformations in which a placed ligand atom sits too close to a
+	scaffold atom or to an atom of another ligand.  Two atoms clash when
+	they are closer than scale times the sum of their covalent radii.
+
+	Scaffold atoms are held in a CellList, so each placed atom only looks at
+	the scaffold atoms in its neighborhood, and all conformations of a mode
+	are checked in a single query.  The metal is left alone since its
+	position is set by the binding mode.
+	'''
+	def __init__(self, scaffold, scale=0.7, check_ligands=True):
+		self.scale = scale
+		self.checkLigands = check_ligands
+		atoms = scaffold.atom_list
+		self.radii = covalentRadii(atoms.elements)
+		maxRadius = max(max(covalent_radii.values()), default_radius)
+		scaffoldRadius = self.radii.max() if len(self.radii) else 0.0
+		self.cells = CellList(atoms.coords, scale*(scaffoldRadius + maxRadius))
+
+		self.checked = 0
+		self.pruned = 0
+		self.prunedModes = 0
+
+	def filter(self, absModes):
+		for mode in absModes:
+			keep = self.checkMode(mode)
+			self.checked += len(keep)
+			pruned = int(np.count_nonzero(~keep))
+			self.pruned += pruned
+			stats.count('conformersPruned', pruned)
+			if not keep.all():
+				mode.removeConformations(keep)
+			if mode.conformations:
+				yield mode
+			else:
+				self.prunedModes += 1
+
+	def checkMode(self, mode):
+		'''
+		Returns a boolean array over the mode's conformations, True for the
+		ones without a clash
+		'''
+		confs = mode.conformations
+		if not confs or len(confs[0]) <= 1:
+			return np.ones(len(confs), dtype=bool)
+
+		coords = np.stack([conf.coords[1:] for conf in confs])
+		elements = np.stack([conf.elements[1:] for conf in confs])
+		groups = np.stack([mode.getLigandGroups(i)[1:] 
+									for i in range(len(confs))])
+		return self.checkCoords(coords, elements, groups)
+
+	def checkCoords(self, coords, elements, groups):
+		'''
+		Returns a boolean array over an (n, atoms, 3) stack of ligand
+		coordinates, without the metal, True where nothing clashes.  elements
+		and groups give each atom's element and ligand position, either per
+		stack entry as (n, atoms) or shared as (atoms,)
+		'''
+		num, numAtoms = coords.shape[:2]
+		labels, inverse = np.unique(np.asarray(elements), return_inverse=True)
+		radii = covalentRadii(labels)[inverse].reshape(np.shape(elements))
+		radii = np.broadcast_to(radii, (num, numAtoms))
+		bad = np.zeros(num, dtype=bool)
+
+		pointIdx, atomIdx, dist = self.cells.query(coords.reshape(-1, 3),
+																	self.cells.cellSize)
+		clash = dist < self.scale*(radii.ravel()[pointIdx] + self.radii[atomIdx])
+		bad[pointIdx[clash] // numAtoms] = True
+
+		if self.checkLigands and numAtoms > 1:
+			groups = np.broadcast_to(groups, (num, numAtoms))
+			dist = np.linalg.norm(coords[:, :, None, :] - coords[:, None, :, :],
+											axis=-1)
+			cutoff = self.scale*(radii[:, :, None] + radii[:, None, :])
+			other = groups[:, :, None] != groups[:, None, :]
+			bad |= np.any((dist < cutoff) & other, axis=(1, 2))
+
+		return ~bad
+
+	def settings(self):
+		return (type(self).__name__, self.scale, self.checkLigands)
+
+	def report(self):
+		return {'checked': self.checked, 'pruned': self.pruned,
+					'prunedModes': self.prunedModes}
+
+class DuplicateFilter(ModeFilter):
+	'''
+	Removes conformations that are geometrically the same as one already
+	seen for an equal Combination, typically produced by different binding
+	mode files that place the same ligand set onto the same positions.
+
+	Each conformation gets a fingerprint of element tagged, quantized
+	distances between adsorbate (metal and ligand) atoms and from adsorbate
+	atoms to scaffold atoms within env_cutoff.  The fingerprint does not
+	depend on atom order, so it is a cheap hash key.  Only when two
+	fingerprints collide is the more expensive matchedRMSD computed, in the
+	scaffold frame, and the conformation is dropped if it falls below
+	rmsd_tol.  Structures that are only equivalent by a rotation of the
+	scaffold are not treated as duplicates.
+
+	Clusterizer yields every mode of a Combination consecutively, so the
+	seen fingerprints are dropped whenever the Combination changes and
+	memory is bounded by the largest Combination rather than the whole run.
+	'''
+	scope = 'combination'
+
+	def __init__(self, scaffold, resolution=0.05, rmsd_tol=0.05, 
+						env_cutoff=4.0):
+		self.resolution = resolution
+		self.rmsdTol = rmsd_tol
+		self.envCutoff = env_cutoff
+		self.scaffold = scaffold
+		self._scaffoldElements = np.array([elementSymbol(str(e)) for e in
+															scaffold.atom_list.elements])
+		self._seen = {}
+		self._combo = None
+
+		self.checked = 0
+		self.duplicates = 0
+		self.collisions = 0
+		self.prunedModes = 0
+
+	def filter(self, absModes):
+		for mode in absModes:
+			if mode.combo != self._combo:
+				self._seen.clear()
+				self._combo = mode.combo
+			keep = np.array([self.isNew(mode.combo, conf) 
+									for conf in mode.conformations], dtype=bool)
+			self.checked += len(keep)
+			duplicates = int(np.count_nonzero(~keep))
+			self.duplicates += duplicates
+			stats.count('conformersPruned', duplicates)
+			if not keep.all():
+				mode.removeConformations(keep)
+			if mode.conformations:
+				yield mode
+			else:
+				self.prunedModes += 1
+
+	def fingerprint(self, conformation):
+		'''
+		Returns the order independent, quantized distance fingerprint of a
+		conformation
+		'''
+		elements = np.array([elementSymbol(str(e)) for e in conformation.elements])
+		coords = conformation.coords
+		i, j = np.triu_indices(len(coords), k=1)
+		internal = np.linalg.norm(coords[i] - coords[j], axis=1)
+		ordered = elements[i] <= elements[j]
+		pairs = sorted(zip(np.where(ordered, elements[i], elements[j]).tolist(),
+								np.where(ordered, elements[j], elements[i]).tolist(),
+								self._quantize(internal)))
+
+		dist = np.linalg.norm(coords[:, None, :] - 
+										self.scaffold.atom_list.coords[None, :, :], axis=-1)
+		a, s = np.nonzero(dist < self.envCutoff)
+		env = sorted(zip(elements[a].tolist(), self._scaffoldElements[s].tolist(),
+								self._quantize(dist[a, s])))
+
+		return tuple(pairs), tuple(env)
+
+	def _quantize(self, distances):
+		return np.rint(distances / self.resolution).astype(np.int64).tolist()
+
+	def isNew(self, combo, conformation):
+		'''
+		Returns False if an equivalent conformation has already been seen for
+		an equal Combination, otherwise records it and returns True
+		'''
+		key = (combo, self.fingerprint(conformation))
+		seen = self._seen.setdefault(key, [])
+		for other in seen:
+			rmsd = matchedRMSD(conformation.coords, conformation.elements,
+										other.coords, other.elements)
+			if rmsd < self.rmsdTol:
+				return False
+			self.collisions += 1
+		seen.append(conformation)
+		return True
+
+	def settings(self):
+		return (type(self).__name__, self.resolution, self.rmsdTol, 
+					self.envCutoff)
+
+	def report(self):
+		return {'checked': self.checked, 'duplicates': self.duplicates,
+					'collisions': self.collisions, 'prunedModes': self.prunedModes}
+
+class ScoreFilter(ModeFilter):
+	'''
+	Scores each conformation with a cheap pairwise energy between the
+	adsorbate (metal and ligand) atoms and the scaffold atoms within cutoff,
+	found with a CellList, and keeps only the top lowest scoring
+	conformations of each Combination, or of each metal with per='metal'.
+	The scores are kept on the surviving modes as mode.scores, which
+	G09Output writes into the title line.
+
+	Each pair contributes a Lennard-Jones term, with its minimum at
+	sigma_scale times the sum of the two covalent radii and depth epsilon,
+	and a Coulomb term in kcal/mol screened by dielectric.  Each ligand's
+	charge, in the state the Combination was built with, sits on its head
+	atom and the metal carries the rest of the Combination's charge.
+	Scaffold atoms take their partial charges from charges, either a dict by
+	element or a list with one per atom (see partialCharges).  The score is
+	only meant to rank siblings, not as an energy.
+
+	The Clusterizer yields every mode of a Combination (and every
+	Combination of a metal) one after another, so modes are only held until
+	the next group starts.  Selecting per Combination gives the same files
+	when the screen is sharded, per metal does not.  The scope is per, so a
+	resumed run rebuilds whole groups and compares the same modes as a full
+	run.
+	'''
+	def __init__(self, scaffold, top=10, per='combination', cutoff=8.0,
+						epsilon=0.2, sigma_scale=1.0, dielectric=4.0, charges=None):
+		if per not in ('combination', 'metal'):
+			raise ValueError("per must be 'combination' or 'metal', not %s" % per)
+		self.top = top
+		self.per = per
+		self.scope = per
+		self.cutoff = cutoff
+		self.epsilon = epsilon
+		self.sigmaScale = sigma_scale
+		self.dielectric = dielectric
+		if charges is None:
+			charges = default_charges
+		self.charges = dict(charges) if isinstance(charges, dict) else \
+								[float(charge) for charge in charges]
+
+		atoms = scaffold.atom_list
+		self.cells = CellList(atoms.coords, cutoff)
+		self.radii = covalentRadii(atoms.elements)
+		self.scaffoldCharges = self.partialCharges(scaffold)
+
+		self.checked = 0
+		self.pruned = 0
+		self.prunedModes = 0
+
+	def filter(self, absModes):
+		group, key = [], None
+		for mode in absModes:
+			modeKey = mode.combo if self.per == 'combination' else \
+							mode.combo.metal.name
+			if group and modeKey != key:
+				for kept in self.select(group):
+					yield kept
+				group = []
+			key = modeKey
+			mode.scores = self.scoreMode(mode).tolist()
+			group.append(mode)
+		for kept in self.select(group):
+			yield kept
+
+	def select(self, group):
+		'''
+		Keeps the self.top lowest scores of a group of modes, ties going to
+		the earlier conformation, and yields the modes with any left
+		'''
+		scores = np.concatenate([np.asarray(mode.scores, dtype=np.float64) 
+										for mode in group] or [np.zeros(0)])
+		keep = np.zeros(len(scores), dtype=bool)
+		keep[np.argsort(scores, kind='stable')[:self.top]] = True
+		self.checked += len(scores)
+		pruned = int(np.count_nonzero(~keep))
+		self.pruned += pruned
+		stats.count('conformersPruned', pruned)
+
+		start = 0
+		for mode in group:
+			end = start + len(mode.conformations)
+			if not keep[start:end].all():
+				mode.removeConformations(keep[start:end])
+			start = end
+			if mode.conformations:
+				yield mode
+			else:
+				self.prunedModes += 1
+
+	def partialCharges(self, scaffold):
+		'''
+		Returns the charge of each scaffold atom.  A list of charges is used as
+		given.  Charges by element are balanced to sum to scaffold.charge by
+		spreading what is left over the hydrogens capping a Si or Al, which
+		stand in for the bonds cut to make the cluster, or over every atom
+		when there are no caps
+		'''
+		atoms = scaffold.atom_list
+		if not isinstance(self.charges, dict):
+			if len(self.charges) != len(atoms):
+				raise ValueError('Got %d scaffold charges for %d atoms' % 
+										(len(self.charges), len(atoms)))
+			return np.array(self.charges)
+
+		elements = np.array([elementSymbol(str(e)) for e in atoms.elements])
+		charges = np.array([self.charges.get(e, 0.0) for e in elements])
+		if not len(charges):
+			return charges
+		caps = []
+		hydrogens = np.flatnonzero(elements == 'H')
+		if len(hydrogens):
+			dist = np.linalg.norm(atoms.coords[hydrogens, None, :] - 
+											atoms.coords[None, :, :], axis=-1)
+			dist[np.arange(len(hydrogens)), hydrogens] = np.inf
+			nearest = elements[np.argmin(dist, axis=1)]
+			caps = hydrogens[np.isin(nearest, ['Si', 'Al'])]
+		if len(caps):
+			charges[caps] = 0.0
+		else:
+			caps = np.arange(len(charges))
+		charges[caps] += (scaffold.charge - charges.sum()) / len(caps)
+		return charges
+
+	def atomCharges(self, combo, ligands):
+		'''
+		Returns the charge of each atom of a conformation built from the
+		Combination's metal and ligands in the given order.  A ligand found in
+		several charge states in the Combination gets their mean
+		'''
+		states = {}
+		for lig, charge in zip(combo.ligands, combo.ligandCharges):
+			states.setdefault(lig.name, []).append(charge)
+		charges = [0.0]
+		for lig in ligands:
+			ligCharges = np.zeros(len(lig.atom_list))
+			ligCharges[lig.getHeadIndex()] = np.mean(states[lig.name])
+			charges.extend(ligCharges)
+		charges[0] = combo.charge - sum(charges[1:])
+		return charges
+
+	def scoreMode(self, mode):
+		'''
+		Returns an array of the score of each of the mode's conformations
+		'''
+		confs = mode.conformations
+		if not confs:
+			return np.zeros(0)
+		numAtoms = len(confs[0])
+		coords = np.stack([conf.coords for conf in confs])
+		elements = np.stack([conf.elements for conf in confs])
+		labels, inverse = np.unique(elements, return_inverse=True)
+		radii = covalentRadii(labels)[inverse].reshape(-1)
+		charges = np.array([self.atomCharges(mode.combo, ligands) 
+									for ligands in mode.assignments]).reshape(-1)
+		return self.score(coords.reshape(-1, 3), radii, charges, 
+								numAtoms)
+
+	def score(self, points, radii, charges, num_atoms):
+		'''
+		Sums the pair energies of consecutive blocks of num_atoms points, each
+		block being one conformation
+		'''
+		pointIdx, atomIdx, dist = self.cells.query(points, self.cutoff)
+		dist = np.maximum(dist, 0.5)
+		sigma = self.sigmaScale*(radii[pointIdx] + self.radii[atomIdx]) / 2**(1/6.)
+		ratio = (sigma / dist)**6
+		energy = 4*self.epsilon*(ratio*ratio - ratio)
+		energy += coulomb*charges[pointIdx]*self.scaffoldCharges[atomIdx] / \
+						(self.dielectric*dist)
+		return np.bincount(pointIdx // num_atoms, weights=energy, 
+									minlength=len(points) // num_atoms)
+
+	def settings(self):
+		return (type(self).__name__, self.top, self.per, self.cutoff, 
+					self.epsilon, self.sigmaScale, self.dielectric, 
+					sorted(self.charges.items()) if isinstance(self.charges, dict)
+					else tuple(self.charges))
+
+	def report(self):
+		return {'checked': self.checked, 'pruned': self.pruned,
+					'prunedModes': self.prunedModes}
@@ -1,7 +1,23 @@
 
 from abc import ABCMeta, abstractmethod
-import string
 import os
+from atoms import AtomTable
+from instrument import stats
+import numpy as np
+import threading
+import hashlib
+import json
+import tarfile
+import zipfile
+import io
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+try:
+	import queue
+except ImportError:
+	import Queue as queue
 
 class GaussianInput(object):
 	'''
@@ -16,92 +32,319 @@ class GaussianInput(object):
 		'''Return absolute file location'''
 		pass
 
-	def readHeader(self, line_list):
-		# Need to read in header information and parse out extraneous stuff
-		# (chk, etc.)
+	def parseInput(self, path, cache=None):
+		'''
+		Returns (header, charge, unpaired, atom_start, atoms) for a Gaussian
+		input file, where atoms is an AtomTable of the whole atom block.  If a
+		ParseCache is given and holds an entry for the unchanged file, the file
+		is not read at all.
+		'''
+		with stats.stage('parse'):
+			if cache is not None:
+				parsed = cache.get(path)
+				if parsed is not None:
+					stats.count('parseCacheHits')
+					return parsed
+
+			with open(path, 'rb') as infile:
+				data = infile.read()
+			parsed = self.parseInputBytes(data)
+			stats.count('filesParsed')
+			stats.count('bytesParsed', len(data))
+
+			if cache is not None:
+				cache.put(path, parsed)
+			return parsed
+
+	def parseInputBytes(self, data):
+		'''
+		Single pass parser over the raw bytes of an input file.  The header,
+		charge and multiplicity, and atom block are collected in one sweep over
+		the lines, and the coordinates are converted to floats in a single
+		array call rather than atom by atom.
+		'''
+		lines = data.splitlines()
 
 		header = []
-		title_index = 0
-		charge = 0
-		mult = 0
-		unpaired_e = 0
-
-		for index, line in enumerate(line_list):
-			if 'Title Card Required' in line:
+		title_index = None
+		for index, line in enumerate(lines):
+			if b'Title Card Required' in line:
 				title_index = index
 				break
-			if '%' in line:
+			if b'%' in line:
 				continue
 			header.append(line.rstrip())
+		if title_index is None:
+			raise ValueError('No "Title Card Required" line in Gaussian input')
 
-		# Need to get rid of extra line between head and title card
-		header.pop()
-		header = str(*header)
+		# Need to get rid of extra lines between head and title card
+		while header and not header[-1]:
+			header.pop()
+		header = b'\n'.join(header).decode('utf-8')
 
-		# Need to gather charges and unpaired electrons
-		charge_mult = line_list[title_index+2].split()
+		charge_mult = lines[title_index+2].split()
 		charge = int(charge_mult[0])
-		mult = int(charge_mult[1])
-		unpaired_e = mult - 1
-
+		unpaired_e = int(charge_mult[1]) - 1
 		atom_start = title_index + 3
 
-		return header, charge, unpaired_e, atom_start
-
-	def readAtoms(self, start_ind, lines):
-		# Returns a list of atomtype, frozen(y/n), x, y, z coordinates
-
-		atom_list = []
+		elements, frozen, coords = [], [], []
+		for line in lines[atom_start:]:
+			split_line = line.split()
+			if not split_line or not split_line[0][:1].isalpha():
+				break
+			elements.append(split_line[0].decode('utf-8'))
+			if split_line[1] == b'0' or split_line[1] == b'-1':
+				frozen.append(split_line[1])
+				coords.append(split_line[2:5])
+			else:
+				frozen.append(b'0')
+				coords.append(split_line[1:4])
 
-		for index, line in enumerate(lines[start_ind:]):
-			atomtype = None
-			frozen = None
-			x, y, z = None, None, None
+		atoms = AtomTable(elements, np.array(frozen, dtype=np.int8),
+								np.array(coords, dtype=np.float64).reshape(-1, 3))
+		return header, charge, unpaired_e, atom_start, atoms
 
-			split_line = list(line.split())
+class ParseCache(object):
+	'''
+	An on-disk cache of parsed Gaussian inputs, so that repeated screening
+	runs skip parsing files that haven't changed.  Entries are keyed on the
+	absolute path and are only used while the file's modification time and
+	size still match.  The cache is stored as a single binary pickle of
+	numpy arrays and is written back by save().
+	'''
+	def __init__(self, cache_file):
+		self.cache_file = os.path.abspath(cache_file)
+		self.hits = 0
+		self.misses = 0
+		self._dirty = False
+		self._entries = {}
+		if os.path.exists(self.cache_file):
+			try:
+				with open(self.cache_file, 'rb') as infile:
+					self._entries = pickle.load(infile)
+			except Exception:
+				# A corrupt or incompatible cache is simply rebuilt
+				self._entries = {}
+
+	def _stamp(self, path):
+		stat = os.stat(path)
+		mtime = getattr(stat, 'st_mtime_ns', None)
+		if mtime is None:
+			mtime = int(stat.st_mtime * 1e9)
+		return mtime, stat.st_size
+
+	def get(self, path):
+		path = os.path.abspath(path)
+		entry = self._entries.get(path)
+		if entry is not None and entry[0] == self._stamp(path):
+			self.hits += 1
+			return entry[1]
+		self.misses += 1
+		return None
+
+	def put(self, path, parsed):
+		path = os.path.abspath(path)
+		self._entries[path] = (self._stamp(path), parsed)
+		self._dirty = True
+
+	def save(self):
+		'''
+		Write the cache to disk if anything changed.  Written to a temporary
+		file first so an interrupted save never leaves a broken cache
+		'''
+		if not self._dirty:
+			return
+		tmp = self.cache_file + '.tmp'
+		with open(tmp, 'wb') as outfile:
+			pickle.dump(self._entries, outfile, pickle.HIGHEST_PROTOCOL)
+		getattr(os, 'replace', os.rename)(tmp, self.cache_file)
+		self._dirty = False
+
+class OutputManifest(object):
+	'''
+	Records, for every AbstractMode written to an output directory, a hash
+	of everything its files were built from (scaffold, binding mode,
+	combination, ligands, symmetry and filter settings) along with the names
+	of the files it produced and the writer settings used.  Kept as
+	manifest.json in the output directory, so a later run into the same
+	directory can skip modes whose inputs haven't changed and whose files
+	are still on disk; see Clusterizer.iterModes and G09Output(resume=True).
+
+	Entries that were not part of the latest run are kept, so they can be
+	reused if their inputs return, and their files are reported by stale()
+	rather than deleted.
+	'''
+	version = 1
 
-			if self.startsWithLetter(split_line) == False:
-				break
-			elif self.frozenIsSpecified(split_line) == False:
-				self.addSplit(split_line, atom_list, frozen='0')
-			else:
-				self.addSplit(split_line, atom_list)
+	def __init__(self, dir, filename='manifest.json'):
+		self.dir = os.path.abspath(dir)
+		self.manifest_file = os.path.join(self.dir, filename)
+		self.settings = None
+		self.skipped = 0
+		self.written = 0
+		self._seen = set()
+		self._previous = set()
+		self._entries = {}
+		self._stale = []
+		if os.path.exists(self.manifest_file):
+			try:
+				with open(self.manifest_file) as infile:
+					data = json.load(infile)
+				if data.get('version') == self.version:
+					self._entries = data['modes']
+					self._stale = data['stale']
+			except Exception:
+				# A corrupt manifest just means everything is written again
+				self._entries = {}
+				self._stale = []
+		self._owners = self.files()
+
+	def begin(self, settings):
+		'''
+		Start a run with the given writer settings.  Entries written with
+		different settings are never current
+		'''
+		self.settings = self._digest([repr(settings)])
+		self.skipped = 0
+		self.written = 0
+		self._seen = set()
+		self._previous = set(self._owners).union(self._stale)
+
+	def _digest(self, parts):
+		digest = hashlib.sha1()
+		for part in parts:
+			if not isinstance(part, bytes):
+				part = str(part).encode('utf-8')
+			digest.update(part)
+			digest.update(b'\0')
+		return digest.hexdigest()
+
+	def _tableParts(self, table):
+		return ['|'.join(table.elements.tolist()), table.frozen.tobytes(),
+					np.round(table.coords, 6).tobytes()]
+
+	def modeKey(self, combo, binding, scaffold, symmetry=True, filters=()):
+		'''
+		Returns the hash of everything the files of one Combination-BindingMode
+		pair are built from
+		'''
+		ligands = sorted(self._digest([lig.name, lig.getHeadIndex(), 
+									lig.getTailIndex()] + self._tableParts(lig.atom_list))
+								for lig in combo.ligands)
+		parts = self._tableParts(scaffold.atom_list)
+		parts += [scaffold.charge, scaffold.unpaired]
+		parts += self._tableParts(binding.metal_ligand_list)
+		parts += [combo.metal.name, combo.charge, combo.unpaired, symmetry]
+		parts += ligands
+		parts += [repr(modeFilter.settings()) for modeFilter in filters]
+		return self._digest(parts)
+
+	def groupKeys(self, keys):
+		'''
+		Returns the keys of a group of pairs that are built together, each one
+		also covering the keys of the rest of the group and its position in it
+		'''
+		group = self._digest(keys)
+		return [self._digest([key, group, i]) for i, key in enumerate(keys)]
 
-		return atom_list
-	
-	def addSplit(self, split_line, atom_list, frozen=None):
-		# Helper function for splitting atom lines into components.  If frozen
-		# is default, parses like normal.  Otherwise utilizes the provided
-		# value for frozen
+	def repeatKey(self, key, count):
+		'''
+		Returns the key of the count'th pair of a run with the same inputs as
+		an earlier one, so identical pairs don't share an entry
+		'''
+		return key if count == 1 else self._digest([key, count])
 
-		atomtype = None
-		x, y, z = None, None, None
+	def isCurrent(self, key):
+		'''
+		True if key was written with the current settings and all of its
+		files still exist
+		'''
+		entry = self._entries.get(key)
+		if entry is None or entry['settings'] != self.settings:
+			return False
+		return all(os.path.exists(os.path.join(self.dir, name)) 
+						for name in entry['names'])
 
-		if frozen == None:
-			atom_list.append(split_line)
-		else:
-			atomtype = split_line[0]
-			x, y, z = split_line[1], split_line[2], split_line[3]
-			result = [atomtype, frozen, x, y, z]
-			atom_list.append(result)
+	def names(self, key):
+		return list(self._entries[key]['names'])
 
-	def frozenIsSpecified(self, atom_line):
-		# Returns boolean of whether or not a frozen/non-frozen coordinate
-		# is specified within a gaussian input line
+	def keep(self, key):
+		self._seen.add(key)
+		self.skipped += len(self._entries[key]['names'])
 
-		if atom_line[1] == '0' or atom_line[1] == '-1':
-			return True
-		return False
+	def record(self, key, names):
+		'''
+		Record the files written for key.  Any other entry that owned one of
+		these names has been overwritten and is dropped
+		'''
+		for name in names:
+			owner = self._owners.get(name)
+			if owner is not None and owner != key:
+				self._drop(owner)
+		self._drop(key)
+		self._entries[key] = {'settings': self.settings, 'names': list(names)}
+		self._owners.update((name, key) for name in names)
+		self._seen.add(key)
+		self.written += len(names)
+
+	def _drop(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			for name in entry['names']:
+				if self._owners.get(name) == key:
+					del self._owners[name]
+		self._seen.discard(key)
+
+	def files(self):
+		'''
+		Returns a dict of every recorded file name to the key of its inputs
+		'''
+		return dict((name, key) for key, entry in self._entries.items() 
+							for name in entry['names'])
 
-	def startsWithLetter(self, atom_line):
-		# Return boolean of whether or not the provided input line begins
-		# with a letter, primarily for identifying atom lines
+	def stale(self):
+		'''
+		Returns the sorted names of files on disk that were recorded by an
+		earlier run, or reported stale by one, but not produced by the current
+		one
+		'''
+		current = set()
+		for key in self._seen:
+			current.update(self._entries[key]['names'])
+		self._stale = sorted(name for name in self._previous - current
+							if os.path.exists(os.path.join(self.dir, name)))
+		return list(self._stale)
+
+	def save(self):
+		'''
+		Written to a temporary file first so an interrupted save never leaves
+		a broken manifest
+		'''
+		tmp = self.manifest_file + '.tmp'
+		with open(tmp, 'w') as outfile:
+			json.dump({'version': self.version, 'modes': self._entries,
+							'stale': self._stale}, outfile, sort_keys=True)
+		getattr(os, 'replace', os.rename)(tmp, self.manifest_file)
 
-		if atom_line == []:
-			return False
-		elif atom_line[0][0] in string.ascii_letters:
-			return True
-		return False
+class ResumedMode(object):
+	'''
+	Stands in for an AbstractMode whose files an OutputManifest says are
+	already current, so it was never built.  Writers only count its
+	conformations unless the names they would give them differ from the
+	recorded ones, in which case build() makes the real (filtered)
+	AbstractMode, or None if nothing survives the filters
+	'''
+	def __init__(self, key, combo, binding, scaffold, names, builder):
+		self.inputKey = key
+		self.combo = combo
+		self.bindingMode = binding
+		self.scaffold = scaffold
+		self.names = names
+		self.conformations = []
+		self._builder = builder
+
+	def build(self):
+		return self._builder(self.combo, self.bindingMode)
 
 class OutputTest(object):
 	def write(self, num, mode):
@@ -110,10 +353,10 @@ class OutputTest(object):
 				outfile.write(''.join(line))
 			outfile.write('\n\nTest\n\n0 1\n')
 			for line in mode.scaffold.atom_list:
-				outfile.write(' '.join(line))
+				outfile.write(' '.join(str(each) for each in line))
 				outfile.write('\n')
-			for line in mode.conformations:
-				outfile.write(' '.join(line))
+			for line in mode.conformations[0]:
+				outfile.write(' '.join(str(each) for each in line))
 				outfile.write('\n')
 
 class Output(object):
@@ -140,12 +383,43 @@ class Output(object):
 
 class G09Output(Output):
 	'''
-	For writing final binding modes to disk in a G09 compatible fashion
+	For writing final binding modes to disk in a G09 compatible fashion.
+
+	With writers=0 (the default) every file is written synchronously.  With
+	writers > 0, files are rendered to a string by the caller and handed to a
+	bounded queue of queue_size entries that a pool of writer threads drains
+	in batches, creating each batch's directories before doing a single
+	write per file.  A full queue blocks generation, which keeps memory
+	bounded.  writeAllModes flushes before returning; flush() and close()
+	raise an IOError describing any files that could not be written.
+
+	With resume=True an OutputManifest is kept in the directory.  Pass
+	output.manifest to Clusterizer.iterModes so pairs whose files are
+	current are neither built nor written; files left over from earlier runs
+	are listed in self.stale after writeAllModes.
 	'''
+	title = 'Automatically Generated by ZeoliteClusterizer'
 
-	def __init__(self, dir):
+	def __init__(self, dir, writers=0, queue_size=256, batch_size=32,
+						resume=False):
 		super(G09Output, self).__init__(True, 5, 5, 7, 5)
 		self.dir = os.path.abspath(dir)
+		self.writers = writers
+		self.batch_size = batch_size
+		self.errors = []
+		self._queue = queue.Queue(maxsize=queue_size) if writers > 0 else None
+		self._threads = []
+		self._knownDirs = set()
+		self._lock = threading.Lock()
+		self._scaffoldBlocks = {}
+		self.manifest = OutputManifest(self.dir) if resume else None
+		self.stale = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
 
 	def writeAllModes(self, absModes, header=None, footer=None, makedirs=False):
 		'''
@@ -153,68 +427,435 @@ class G09Output(Output):
 		directory.  Use hash table to iterate conformation number.  See write
 		method for more details.
 		'''
-		# Note: writeAllModes is not properly set up to handle the mixed
-		# conformations that would exists as mixed ligand sets in 
-		# mode.conformations.
 		hashtable = {}
+		manifest = self.manifest
+		if manifest is not None:
+			manifest.begin((type(self).__name__, header, footer, makedirs))
 
 		for mode in absModes:
-			hval = mode.combo._hashval
-			if hval not in hashtable:
-				hashtable[hval] = 0
-			hashtable[hval] += 1
-			conf = hashtable[hval]
-
-			name = [s for s in mode.combo._strings]
-			charge = str(mode.combo.charge + mode.scaffold.charge)
-			unpaired = (mode.combo.unpaired + mode.scaffold.unpaired) % 2
-			mult = str(unpaired+1)
-			unpaired = str(unpaired)
-			name.append('_charge%s_%set_conf%d' % (charge, mult, conf))
-			name = ''.join(name)
-			
-			name = os.path.join(self.dir, name)
-			if makedirs == True:
-				os.makedirs(name)
-				name = os.path.join(name, os.path.basename(name))
-
-			self.write(mode, name, charge=charge, mult=mult)
+			if manifest is not None:
+				self.writeResumable(mode, hashtable, header, footer, makedirs)
+				continue
+			for i, conformation in enumerate(mode.conformations):
+				self.writeConformation(mode, conformation, hashtable, header, 
+												footer, makedirs, self.titleLine(mode, i))
+		with stats.stage('flush'):
+			self.flush()
+
+		if manifest is not None:
+			self.stale = manifest.stale()
+			manifest.save()
+
+	def writeResumable(self, mode, hashtable, header=None, footer=None, 
+								makedirs=False):
+		'''
+		Write a mode and record its files in self.manifest.  A ResumedMode is
+		only counted, unless earlier modes changed how its conformations are
+		numbered, in which case it is built and written again.  Every mode has
+		to carry the inputKey given to it by Clusterizer.resumeModes, which
+		covers the filter and rotamer settings
+		'''
+		manifest = self.manifest
+		key = getattr(mode, 'inputKey', None)
+		if key is None:
+			raise ValueError('With resume=True the modes have to come from '
+									'Clusterizer.iterModes(manifest=output.manifest)')
+
+		if isinstance(mode, ResumedMode):
+			start = hashtable.get(mode.combo, 0)
+			names = []
+			for _ in mode.names:
+				name = self.conformationName(mode, hashtable)[0]
+				names.append(self.relativeName(name, makedirs))
+			if names == mode.names:
+				manifest.keep(key)
+				return
+			hashtable[mode.combo] = start
+			mode = mode.build()
+			if mode is None:
+				manifest.record(key, [])
+				return
+
+		names = []
+		for i, conformation in enumerate(mode.conformations):
+			path = self.writeConformation(mode, conformation, hashtable, header, 
+												footer, makedirs, self.titleLine(mode, i))
+			names.append(os.path.relpath(path, self.dir))
+		manifest.record(key, names)
+
+	def relativeName(self, name, makedirs=False):
+		'''
+		Returns the path of a conformation's file relative to self.dir
+		'''
+		if makedirs == True:
+			return os.path.join(name, name) + '.com'
+		return name + '.com'
+
+	def titleLine(self, mode, index):
+		'''
+		Returns the title line of a mode's conformation, with its score when
+		the mode was scored, e.g. by a ScoreFilter
+		'''
+		scores = getattr(mode, 'scores', None)
+		if scores is None:
+			return self.title
+		return '%s, score %.4f' % (self.title, scores[index])
+
+	def writeConformation(self, mode, conformation, hashtable, header=None, 
+									footer=None, makedirs=False, title=None):
+		'''
+		Name and write a single conformation of an AbstractMode, numbering it
+		with the per-Combination counter in hashtable.  Returns the path of
+		the file
+		'''
+		name, charge, mult = self.conformationName(mode, hashtable)
+		
+		name = os.path.join(self.dir, name)
+		if makedirs == True:
+			self.makeDirectory(name)
+			name = os.path.join(name, os.path.basename(name))
+
+		self.write(mode, name, charge=charge, mult=mult, header=header, 
+					footer=footer, conformation=conformation, title=title)
+		return name + '.com'
+
+	def conformationName(self, mode, hashtable):
+		'''
+		Returns the (name, charge, mult) of the next conformation of a mode's
+		Combination, e.g. OHOHZn_charge0_1et_conf2
+		'''
+		combo = mode.combo
+		if combo not in hashtable:
+			hashtable[combo] = 0
+		hashtable[combo] += 1
+		conf = hashtable[combo]
+
+		name = [mode.combo.getName()]
+		charge = str(mode.combo.charge + mode.scaffold.charge)
+		unpaired = (mode.combo.unpaired + mode.scaffold.unpaired) % 2
+		mult = str(unpaired+1)
+		name.append('_charge%s_%set_conf%d' % (charge, mult, conf))
+		return ''.join(name), charge, mult
+
+	def makeDirectory(self, path):
+		# Writer threads create directories themselves, in batches
+		if self._queue is None and not os.path.isdir(path):
+			os.makedirs(path)
 	
-	def write(self, mode, name, charge='0', mult='1', header=None, footer=None):
+	def write(self, mode, name, charge='0', mult='1', header=None, footer=None,
+					conformation=None, title=None):
 		'''
 		Write a single file.  Name should have the absolute path prepended to the
 		.com filename.  If alternative headers and footers are provided, write
 		those instead of what's provided in the ScaffoldRing.  The header should
 		exclude the Title Card Required line because it will be added in by the
-		method.
+		method.  Writes the first of the mode's conformations unless another
+		is provided, titled with self.title unless another title is.
 		'''
 		if header == None:
 			header = mode.scaffold.head_lines
+		if conformation is None:
+			conformation = mode.conformations[0]
+		if title is None:
+			title = self.title
+
+		with stats.stage('write'):
+			text = self.render(mode, name, charge, mult, header, footer, 
+									conformation, title)
+			self.emit(name + '.com', text)
+		stats.count('filesWritten')
+		stats.count('bytesWritten', len(text))
+
+	def render(self, mode, name, charge, mult, header, footer, conformation,
+					title=None):
+		'''
+		Returns the full contents of a single input file as bytes.  The
+		scaffold block is rendered once per ScaffoldRing and reused, so only
+		the adsorbate atoms are formatted for each file
+		'''
+		text = []
+		text.append('%chk=' + os.path.basename(name) + '.chk' + '\n')
+		text.append(header.rstrip('\n') + '\n')
 
-		with open(name + '.com', 'w') as comfile:
-			check = '%chk=' + os.path.basename(name) + '.chk' + '\n'
-			comfile.write(check)
-			comfile.write(header.rstrip('\n') + '\n')
-			
-			comfile.write('\nAutomatically Generated by ZeoliteClusterizer\n\n')
-			comfile.write('%s %s\n' % (charge, mult))
+		text.append('\n%s\n\n' % (title or self.title))
+		text.append('%s %s\n' % (charge, mult))
+		head = ''.join(text).encode('utf-8')
 
-			# Refactor these for loops as some point
-			for line in mode.scaffold.atom_list:
-				# Think of a way to make this not look like garbage
-				params = (self.atom_width, line[0], self.frozen_width, line[1], 
-							self.coord_digits, float(line[2]), self.coord_digits, 
-							float(line[3]), self.coord_digits, float(line[4]))
-				comfile.write('%-*s %-*s %-*f %-*f %-*f\n' % params)
-
-			for line in mode.conformations:
-				params = (self.atom_width, line[0], self.frozen_width, line[1],
-                     self.coord_digits, float(line[2]), self.coord_digits,
-                     float(line[3]), self.coord_digits, float(line[4]))
-				comfile.write('%-*s %-*s %-*f %-*f %-*f\n' % params)
-
-			comfile.write('\n')
-			if footer != None:
-				comfile.write(footer)
-
-			comfile.write('\n\n\n')
+		text = [self.formatAtoms(conformation), '\n']
+		if footer != None:
+			text.append(footer)
+		text.append('\n\n\n')
+		tail = ''.join(text).encode('utf-8')
+
+		return b''.join([head, self.scaffoldBlock(mode.scaffold), tail])
+
+	def scaffoldBlock(self, scaffold):
+		'''
+		Returns the cached, pre-rendered atom lines of a scaffold as bytes
+		'''
+		atoms = scaffold.atom_list
+		cached = self._scaffoldBlocks.get(id(atoms))
+		if cached is None or cached[0] is not atoms:
+			cached = (atoms, self.formatAtoms(atoms).encode('utf-8'))
+			self._scaffoldBlocks[id(atoms)] = cached
+		return cached[1]
+
+	def emit(self, path, text):
+		'''
+		Write rendered text to path, either directly or through the writer
+		threads.  Blocks while the queue is full
+		'''
+		if self._queue is None:
+			with open(path, 'wb') as comfile:
+				comfile.write(text)
+			return
+
+		if not self._threads:
+			self._startWriters()
+		self._queue.put((path, text))
+
+	def _startWriters(self):
+		for _ in range(self.writers):
+			thread = threading.Thread(target=self._drain)
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def _drain(self):
+		'''
+		Writer thread loop.  Takes a batch of files off the queue, creates any
+		directories the batch needs once, then writes each file in one call.
+		A None entry stops the thread
+		'''
+		while True:
+			batch = [self._queue.get()]
+			while batch[-1] is not None and len(batch) < self.batch_size:
+				try:
+					batch.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+
+			files = [item for item in batch if item is not None]
+			try:
+				dirs = set(os.path.dirname(path) for path, _ in files)
+				failed = {}
+				for directory in dirs - self._knownDirs:
+					try:
+						os.makedirs(directory)
+					except OSError as e:
+						if not os.path.isdir(directory):
+							failed[directory] = e
+							continue
+					self._knownDirs.add(directory)
+
+				for path, text in files:
+					if os.path.dirname(path) in failed:
+						self._recordError(path, failed[os.path.dirname(path)])
+						continue
+					try:
+						with open(path, 'wb') as comfile:
+							comfile.write(text)
+					except (IOError, OSError) as e:
+						self._recordError(path, e)
+			finally:
+				for _ in batch:
+					self._queue.task_done()
+
+			if batch[-1] is None:
+				return
+
+	def _recordError(self, path, error):
+		with self._lock:
+			self.errors.append((path, error))
+
+	def flush(self):
+		'''
+		Wait until every queued file has been written.  Raises an IOError
+		listing the failures if any writes failed since the last flush
+		'''
+		if self._queue is not None and self._threads:
+			self._queue.join()
+
+		with self._lock:
+			errors, self.errors = self.errors, []
+		if errors:
+			lines = ['%s: %s' % (path, error) for path, error in errors[:10]]
+			if len(errors) > 10:
+				lines.append('... and %d more' % (len(errors) - 10))
+			raise IOError('%d output files could not be written\n%s' % 
+								(len(errors), '\n'.join(lines)))
+
+	def close(self):
+		'''
+		Flush and stop the writer threads
+		'''
+		try:
+			self.flush()
+		finally:
+			for _ in self._threads:
+				self._queue.put(None)
+			for thread in self._threads:
+				thread.join()
+			self._threads = []
+
+	def writeAtoms(self, comfile, atoms):
+		comfile.write(self.formatAtoms(atoms))
+
+	def formatAtoms(self, atoms):
+		'''
+		Format the lines of an AtomTable straight from its arrays.  The whole
+		block is formatted by a single % operation over a row-major table of
+		values instead of one operation per atom
+		'''
+		if len(atoms) == 0:
+			return ''
+		line = '%%-%ds %%-%dd %%-%df %%-%df %%-%df\n' % (self.atom_width, 
+						self.frozen_width, self.coord_digits, self.coord_digits,
+						self.coord_digits)
+		values = np.empty((len(atoms), 5), dtype=object)
+		values[:, 0] = atoms.elements
+		values[:, 1] = atoms.frozen
+		values[:, 2:] = atoms.coords
+		return (line * len(atoms)) % tuple(values.ravel().tolist())
+
+class G09ArchiveOutput(G09Output):
+	'''
+	Streams every input file into a single uncompressed tar or zip archive
+	instead of creating a file (and optionally a directory) per
+	conformation.  Member names are the same relative paths G09Output would
+	have created.  A tab separated index of member name, data offset and size
+	is written next to the archive as <archive>.index so individual inputs
+	can be pulled out without scanning.  The archive is only complete once
+	close() has been called.
+	'''
+	def __init__(self, archive, format=None):
+		super(G09ArchiveOutput, self).__init__('.')
+		self.dir = ''
+		self.archive = os.path.abspath(archive)
+		if format is None:
+			format = 'zip' if self.archive.lower().endswith('.zip') else 'tar'
+		if format not in ('tar', 'zip'):
+			raise ValueError('Unknown archive format %s' % format)
+		self.format = format
+		self.index = []
+		self._fileobj = open(self.archive, 'wb')
+		if format == 'tar':
+			self._archive = tarfile.open(fileobj=self._fileobj, mode='w')
+		else:
+			self._archive = zipfile.ZipFile(self._fileobj, 'w', zipfile.ZIP_STORED)
+
+	def makeDirectory(self, path):
+		pass
+
+	def emit(self, path, text):
+		if self.format == 'tar':
+			info = tarfile.TarInfo(path)
+			info.size = len(text)
+			self._archive.addfile(info, io.BytesIO(text))
+			# Data ends on the block boundary the archive now sits at
+			blocks = -(-len(text) // tarfile.BLOCKSIZE)
+			offset = self._archive.offset - blocks*tarfile.BLOCKSIZE
+		else:
+			self._archive.writestr(path, text)
+			info = self._archive.getinfo(path)
+			offset = info.header_offset + 30 + len(info.filename.encode('utf-8')) \
+							+ len(info.extra)
+		self.index.append((path, offset, len(text)))
+
+	def flush(self):
+		self._fileobj.flush()
+
+	def close(self):
+		if self._archive is None:
+			return
+		self._archive.close()
+		self._fileobj.close()
+		self._archive = None
+		with open(self.archive + '.index', 'w') as indexfile:
+			for path, offset, size in self.index:
+				indexfile.write('%s\t%d\t%d\n' % (path, offset, size))
+
+class G09Link1Output(G09Output):
+	'''
+	Packs jobs_per_file conformations into each Gaussian input, joined with
+	--Link1-- lines, to cut the number of files on disk.  Every job keeps its
+	own %chk line with the usual conformation name, and link1_index.txt maps
+	each packed file to the names of the jobs it holds.  The index is
+	started afresh by each writeAllModes and only lists packs that were
+	written.  Packed files are named <prefix>00001.com and so on.  makedirs
+	has no effect.  Writer threads can still be used for the packed files.
+	'''
+	def __init__(self, dir, jobs_per_file=50, prefix='jobs', writers=0, 
+						queue_size=256, batch_size=32):
+		super(G09Link1Output, self).__init__(dir, writers=writers, 
+							queue_size=queue_size, batch_size=batch_size)
+		self.jobs_per_file = jobs_per_file
+		self.prefix = prefix
+		self._jobs = []
+		self._names = []
+		self._indexed = []
+		self._packs = 0
+
+	def makeDirectory(self, path):
+		pass
+
+	def writeConformation(self, mode, conformation, hashtable, header=None,
+									footer=None, makedirs=False, title=None):
+		return super(G09Link1Output, self).writeConformation(mode, conformation,
+									hashtable, header, footer, makedirs=False, title=title)
+
+	def emit(self, path, text):
+		self._jobs.append(text)
+		self._names.append(os.path.splitext(os.path.basename(path))[0])
+		if len(self._jobs) >= self.jobs_per_file:
+			self.writePack()
+
+	def writeAllModes(self, absModes, header=None, footer=None, makedirs=False):
+		'''
+		Like G09Output.writeAllModes, but starts the pack numbering and
+		link1_index.txt afresh
+		'''
+		self._packs = 0
+		self._indexed = []
+		open(os.path.join(self.dir, 'link1_index.txt'), 'w').close()
+		super(G09Link1Output, self).writeAllModes(absModes, header, footer, 
+																makedirs)
+
+	def writePack(self):
+		'''
+		Write the buffered jobs as a single --Link1-- joined input
+		'''
+		if not self._jobs:
+			return
+		self._packs += 1
+		path = os.path.join(self.dir, '%s%05d.com' % (self.prefix, self._packs))
+		data = b'--Link1--\n'.join(self._jobs)
+		names, self._jobs, self._names = self._names, [], []
+		super(G09Link1Output, self).emit(path, data)
+		self._indexed.append((path, names))
+		if self._queue is None:
+			self.writeIndex()
+
+	def writeIndex(self, failed=()):
+		'''
+		Append the jobs of the packs written since the last call to
+		link1_index.txt, leaving out packs whose write failed.  Without writer
+		threads each pack is indexed as soon as it is written, otherwise at
+		each flush
+		'''
+		with open(os.path.join(self.dir, 'link1_index.txt'), 'a') as indexfile:
+			for path, names in self._indexed:
+				if path in failed:
+					continue
+				for name in names:
+					indexfile.write('%s\t%s\n' % (os.path.basename(path), name))
+		self._indexed = []
+
+	def flush(self):
+		self.writePack()
+		if self._queue is not None and self._threads:
+			self._queue.join()
+		with self._lock:
+			failed = set(path for path, _ in self.errors)
+		self.writeIndex(failed)
+		super(G09Link1Output, self).flush()
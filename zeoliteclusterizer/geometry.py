@@ -0,0 +1,168 @@
+import numpy as np
+
+'''
+Batched geometric helpers.  Everything here works on stacks of vectors and
+matrices so that many sites, ligands or conformations are transformed in a
+single array operation instead of atom by atom.
+'''
+
+def normalize(vectors):
+	'''
+	Returns unit vectors along the rows of an (N,3) array.  Zero length rows
+	are left as zeros
+	'''
+	vectors = np.asarray(vectors, dtype=np.float64)
+	lengths = np.linalg.norm(vectors, axis=-1, keepdims=True)
+	return np.divide(vectors, lengths, out=np.zeros_like(vectors),
+							where=lengths > 1e-12)
+
+def alignmentMatrices(a, b):
+	'''
+	Returns an (N,3,3) stack of rotation matrices, the i-th of which rotates
+	the direction a[i] onto the direction b[i].  Built with the Rodrigues
+	formula for all rows at once.  Rows where either vector has zero length
+	give the identity, and antiparallel rows are rotated by 180 degrees about
+	an axis perpendicular to a[i].
+	'''
+	a = normalize(np.atleast_2d(a))
+	b = normalize(np.atleast_2d(b))
+	n = len(a)
+
+	v = np.cross(a, b)
+	c = np.einsum('ij,ij->i', a, b)
+
+	skew = np.zeros((n, 3, 3))
+	skew[:, 0, 1], skew[:, 0, 2] = -v[:, 2], v[:, 1]
+	skew[:, 1, 0], skew[:, 1, 2] = v[:, 2], -v[:, 0]
+	skew[:, 2, 0], skew[:, 2, 1] = -v[:, 1], v[:, 0]
+
+	identity = np.broadcast_to(np.eye(3), (n, 3, 3))
+	antiparallel = c < -1.0 + 1e-9
+	scale = np.zeros(n)
+	np.divide(1.0, 1.0 + c, out=scale, where=~antiparallel)
+	rotations = identity + skew + np.einsum('nij,njk->nik', skew, skew) * \
+						scale[:, None, None]
+
+	if antiparallel.any():
+		# Pick the axis least aligned with a to build a perpendicular one
+		axes = np.eye(3)[np.argmin(np.abs(a[antiparallel]), axis=1)]
+		perp = normalize(np.cross(a[antiparallel], axes))
+		rotations[antiparallel] = 2.0*np.einsum('ni,nj->nij', perp, perp) - \
+											np.eye(3)
+
+	zero = (np.linalg.norm(a, axis=1) == 0) | (np.linalg.norm(b, axis=1) == 0)
+	rotations[zero] = np.eye(3)
+	return rotations
+
+def axisRotations(axes, angles):
+	'''
+	Returns an (N,K,3,3) stack of rotation matrices, turning about each of
+	the N axes by each of the K angles (in radians), built with the
+	Rodrigues formula in one go.  Zero length axes give the identity
+	'''
+	axes = normalize(np.atleast_2d(axes))
+	angles = np.asarray(angles, dtype=np.float64)
+	n = len(axes)
+
+	skew = np.zeros((n, 3, 3))
+	skew[:, 0, 1], skew[:, 0, 2] = -axes[:, 2], axes[:, 1]
+	skew[:, 1, 0], skew[:, 1, 2] = axes[:, 2], -axes[:, 0]
+	skew[:, 2, 0], skew[:, 2, 1] = -axes[:, 1], axes[:, 0]
+	square = np.einsum('nij,njk->nik', skew, skew)
+
+	return np.eye(3) + np.sin(angles)[None, :, None, None]*skew[:, None] + \
+				(1.0 - np.cos(angles))[None, :, None, None]*square[:, None]
+
+def applyRotations(rotations, coords):
+	'''
+	Applies an (N,3,3) stack of rotations to an (M,3) block of coordinates,
+	returning an (N,M,3) array with one rotated copy per matrix
+	'''
+	return np.einsum('nij,mj->nmi', rotations, coords)
+
+class CellList(object):
+	'''
+	A uniform spatial grid over a fixed set of atoms for fast neighbor
+	queries.  Atoms are binned into cubic cells of cell_size and sorted by
+	cell, so the atoms of any cell are a contiguous slice found with a binary
+	search.  A query only looks at the 27 cells around each point, so its
+	cost depends on the local density rather than the total number of atoms.
+	Queries for many points are answered together with array operations.
+	'''
+	def __init__(self, coords, cell_size):
+		self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+		self.cellSize = float(cell_size)
+		if len(self.coords):
+			self._origin = self.coords.min(axis=0) - self.cellSize
+			self._shape = np.floor((self.coords.max(axis=0) - self._origin) / 
+											self.cellSize).astype(np.int64) + 2
+		else:
+			self._origin = np.zeros(3)
+			self._shape = np.ones(3, dtype=np.int64)
+
+		keys = self._keys(self._cells(self.coords))
+		self._order = np.argsort(keys, kind='stable')
+		self._sortedKeys = keys[self._order]
+
+	def _cells(self, points):
+		return np.floor((points - self._origin) / self.cellSize).astype(np.int64)
+
+	def _keys(self, cells):
+		# Cells outside the grid map to -1 and never match an atom
+		inside = np.all((cells >= 0) & (cells < self._shape), axis=-1)
+		keys = (cells[..., 0]*self._shape[1] + cells[..., 1])*self._shape[2] + \
+					cells[..., 2]
+		return np.where(inside, keys, -1)
+
+	def query(self, points, cutoff):
+		'''
+		Returns (point indices, atom indices, distances) for every point-atom
+		pair closer than cutoff, which must not exceed the cell size
+		'''
+		points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+		if cutoff > self.cellSize:
+			raise ValueError('Cutoff %f is larger than the cell size %f' % 
+										(cutoff, self.cellSize))
+
+		cells = self._cells(points)
+		pointIdx, atomIdx = [], []
+		for offset in np.ndindex(3, 3, 3):
+			keys = self._keys(cells + np.array(offset) - 1)
+			starts = np.searchsorted(self._sortedKeys, keys, side='left')
+			ends = np.searchsorted(self._sortedKeys, keys, side='right')
+			counts = np.where(keys >= 0, ends - starts, 0)
+			total = counts.sum()
+			if total == 0:
+				continue
+			# Expand each point's [start, end) slice without a Python loop
+			first = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+			pointIdx.append(np.repeat(np.arange(len(points)), counts))
+			atomIdx.append(self._order[np.arange(total) + first])
+
+		if not pointIdx:
+			empty = np.zeros(0, dtype=np.int64)
+			return empty, empty, np.zeros(0)
+
+		pointIdx = np.concatenate(pointIdx)
+		atomIdx = np.concatenate(atomIdx)
+		distances = np.linalg.norm(points[pointIdx] - self.coords[atomIdx], axis=1)
+		close = distances < cutoff
+		return pointIdx[close], atomIdx[close], distances[close]
+
+def matchedRMSD(coords_a, elements_a, coords_b, elements_b):
+	'''
+	RMSD between two sets of atoms in the same frame where each atom is
+	matched to the closest atom of the same element in the other set, in
+	both directions.  This is zero exactly when the sets are the same up to a
+	permutation of identical atoms, without having to search permutations
+	'''
+	coords_a = np.asarray(coords_a, dtype=np.float64).reshape(-1, 3)
+	coords_b = np.asarray(coords_b, dtype=np.float64).reshape(-1, 3)
+	if len(coords_a) == 0 or len(coords_b) == 0:
+		return 0.0 if len(coords_a) == len(coords_b) else np.inf
+
+	dist = np.linalg.norm(coords_a[:, None, :] - coords_b[None, :, :], axis=-1)
+	same = np.asarray(elements_a)[:, None] == np.asarray(elements_b)[None, :]
+	dist = np.where(same, dist, np.inf)
+	nearest = np.concatenate([dist.min(axis=1), dist.min(axis=0)])
+	return float(np.sqrt(np.mean(nearest**2)))
@@ -0,0 +1,199 @@
+import json
+import os
+import threading
+import time
+try:
+	import cProfile as profile
+except ImportError:
+	import profile
+
+'''
+Opt-in instrumentation of the screening pipeline.  The shared Instrumentation
+in stats is disabled by default, and while it is disabled stage() hands back
+a do-nothing context manager, iterate() returns the iterable untouched and
+count() returns immediately, so the hooks cost next to nothing.
+
+	from instrument import stats
+	stats.enable(profile=['write'])
+	...
+	stats.exportJSON('run.json')
+	stats.saveProfiles('profiles')
+
+Stages are parse, binding, placement, combinations, conformers,
+filter.<Filter>, write and flush.  Counters are filesParsed, bytesParsed,
+parseCacheHits, combinationsTried, combinationsAccepted, combinationsDeduped,
+conformersGenerated, conformersPruned, rotamersPruned, filesWritten and
+bytesWritten.
+'''
+
+try:
+	_cpuTime = time.process_time
+except AttributeError:
+	_cpuTime = time.clock
+
+class _NullStage(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+_nullStage = _NullStage()
+
+class _Stage(object):
+	'''
+	Times one entry into a stage.  Time spent in stages entered inside it is
+	also subtracted from its self time
+	'''
+	def __init__(self, owner, name):
+		self.owner = owner
+		self.name = name
+
+	def __enter__(self):
+		self.children = 0.0
+		stack = self.owner._stack()
+		stack.append(self)
+		self.profiler = self.owner._startProfile(self.name)
+		self.wall = time.time()
+		self.cpu = _cpuTime()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		wall = time.time() - self.wall
+		cpu = _cpuTime() - self.cpu
+		if self.profiler is not None:
+			self.owner._stopProfile(self.name, self.profiler)
+		stack = self.owner._stack()
+		stack.pop()
+		if stack:
+			stack[-1].children += wall
+		self.owner._record(self.name, wall, wall - self.children, cpu)
+		return False
+
+class Instrumentation(object):
+	'''
+	Per stage wall and CPU timers and named counters for a run.  A stage's
+	wall time includes stages entered inside it, while self time does not.
+	Stages entered from several threads add up, so their times can exceed
+	the length of the run.  Work done in worker processes is only seen as
+	the time the main process spends waiting for it.
+
+	Stages named in profile are also captured with cProfile.  Only one
+	profiler runs at a time, so a profiled stage entered inside another one
+	is part of the outer stage's profile.
+	'''
+	def __init__(self):
+		self.enabled = False
+		self.profileStages = set()
+		self.reset()
+
+	def enable(self, profile=()):
+		self.profileStages = set(profile)
+		self.enabled = True
+
+	def disable(self):
+		self.enabled = False
+
+	def reset(self):
+		self.stages = {}
+		self.counters = {}
+		self.profiles = {}
+		self._lock = threading.Lock()
+		self._local = threading.local()
+		self._profiling = False
+		self._started = time.time()
+
+	def stage(self, name):
+		'''
+		Returns a context manager timing the enclosed block as the named stage
+		'''
+		if not self.enabled:
+			return _nullStage
+		return _Stage(self, name)
+
+	def iterate(self, name, iterable):
+		'''
+		Wraps an iterable so only the time spent producing each item is
+		counted toward the named stage, which suits the lazy generators of
+		the pipeline
+		'''
+		if not self.enabled:
+			return iterable
+		return self._timedIter(name, iter(iterable))
+
+	def _timedIter(self, name, iterator):
+		while True:
+			with self.stage(name):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			yield item
+
+	def count(self, name, amount=1):
+		if not self.enabled:
+			return
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def _stack(self):
+		stack = getattr(self._local, 'stack', None)
+		if stack is None:
+			stack = self._local.stack = []
+		return stack
+
+	def _record(self, name, wall, own, cpu):
+		with self._lock:
+			totals = self.stages.get(name)
+			if totals is None:
+				totals = self.stages[name] = {'calls': 0, 'wall': 0.0, 'self': 0.0,
+															'cpu': 0.0}
+			totals['calls'] += 1
+			totals['wall'] += wall
+			totals['self'] += own
+			totals['cpu'] += cpu
+
+	def _startProfile(self, name):
+		if name not in self.profileStages:
+			return None
+		with self._lock:
+			if self._profiling:
+				return None
+			self._profiling = True
+		profiler = self.profiles.get(name)
+		if profiler is None:
+			profiler = self.profiles[name] = profile.Profile()
+		profiler.enable()
+		return profiler
+
+	def _stopProfile(self, name, profiler):
+		profiler.disable()
+		with self._lock:
+			self._profiling = False
+
+	def report(self):
+		'''
+		Returns a dict of the stage timings and counters collected so far
+		'''
+		with self._lock:
+			return {'elapsed': time.time() - self._started,
+						'stages': dict((name, dict(totals))
+											for name, totals in self.stages.items()),
+						'counters': dict(self.counters),
+						'profiles': sorted(self.profiles)}
+
+	def exportJSON(self, path):
+		with open(path, 'w') as outfile:
+			json.dump(self.report(), outfile, indent=1, sort_keys=True)
+
+	def saveProfiles(self, directory):
+		'''
+		Write each captured cProfile as <stage>.prof in directory, readable
+		with pstats or snakeviz
+		'''
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		for name, profiler in self.profiles.items():
+			profiler.dump_stats(os.path.join(directory, name + '.prof'))
+
+stats = Instrumentation()
@@ -1,8 +1,19 @@
-import string
 from gaussian import GaussianInput
-import os, sys
+import os
 import numpy as np
-import copy
+import collections
+import math
+import threading
+try:
+	from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+												FIRST_EXCEPTION, wait)
+except ImportError:
+	# Python 2 without the futures backport loads serially
+	ThreadPoolExecutor = ProcessPoolExecutor = None
+from atoms import AtomTable
+from instrument import stats
+from geometry import alignmentMatrices, applyRotations, axisRotations, normalize
+from filters import ClashFilter
 
 class ScaffoldRing(GaussianInput):
 	'''
@@ -13,52 +24,52 @@ class ScaffoldRing(GaussianInput):
 	def getLoc(self):
 		return self.input_loc
 
-	def __init__(self, comfile):
+	def __init__(self, comfile, cache=None):
 		self.input_loc = os.path.abspath(comfile)
-		with open(comfile,'r') as infile:
-			lines = infile.readlines()
-			
-			self.head_lines, self.charge, self.unpaired, self.atom_start = self.readHeader(lines)
-			self.atom_list = self.readAtoms(self.atom_start, lines)
+		parsed = self.parseInput(self.input_loc, cache)
+		self.head_lines, self.charge, self.unpaired, self.atom_start = parsed[:4]
+		self.atom_list = parsed[4]
 
 class BindingMode(GaussianInput):
 	'''
 	For defining the binding mode rings to be permutated upon.  Primarily for
 	parsing out the metal binding modes and ligand locations.
 	'''
-	def __init__(self, comfile, scaffold_atoms):
+	def __init__(self, comfile, scaffold_atoms, cache=None, tolerance=None):
 		self.input_loc = os.path.abspath(comfile)
-		with open(comfile, 'r') as infile:
-			lines = infile.readlines()
+		self._siteSignatures = {}
+		self._placements = {}
+		self._rotamers = {}
 
-			self.metal_ligand_list = self.getMetalsLigands(lines, scaffold_atoms)
+		# Everything after the scaffold atoms is the metal and ligands
+		atoms = self.parseInput(self.input_loc, cache)[4]
+		if tolerance is not None:
+			self.verifyScaffold(atoms, scaffold_atoms, tolerance)
+		self.metal_ligand_list = atoms[len(scaffold_atoms):]
 
-	def getMetalsLigands(self, lines, scaffold_atoms):
+	def verifyScaffold(self, atoms, scaffold_atoms, tolerance):
 		'''
-		Returns list of metal and ligand locations.  Current implementation
-		is very primative: the method simply compares the list lengths and
-		truncates the leading atoms.  More advanced handling should be
-		implemented at a later time.
+		Checks that the leading atoms of the file are the scaffold, with the
+		same elements and every coordinate within tolerance, and that an "X"
+		metal follows.  Raises a ValueError naming the file otherwise
 		'''
-		atom_list = []
-		scaffold_len = len(scaffold_atoms)
+		n = len(scaffold_atoms)
+		if len(atoms) <= n:
+			raise ValueError('%s has %d atoms, no more than the %d scaffold atoms' 
+									% (self.input_loc, len(atoms), n))
 
-		# Need to find the beginning of the atom list
-		index = 0
-		while('Title Card Required' not in lines[index]):
-			index += 1
-		index += 3
+		prefix = atoms[:n]
+		if not np.array_equal(prefix.elements, scaffold_atoms.elements):
+			raise ValueError('%s: leading atoms do not match scaffold elements' 
+									% self.input_loc)
+		deviation = np.abs(prefix.coords - scaffold_atoms.coords).max() if n else 0
+		if deviation > tolerance:
+			raise ValueError('%s: scaffold coordinates deviate by %f, more than %f' 
+									% (self.input_loc, deviation, tolerance))
+		if not atoms[n:].mask('X').any():
+			raise ValueError('%s: no "X" metal after the scaffold atoms' 
+									% self.input_loc)
 
-		# Want to truncate atom list
-		index += scaffold_len
-		line = lines[index].split()
-		while(self.startsWithLetter(line) == True):
-			self.addSplit(line, atom_list)
-			index += 1
-			line = lines[index].split()
-
-		return atom_list
-	
 	def getLoc(self):
 		return self.input_loc
 
@@ -73,90 +84,916 @@ class BindingMode(GaussianInput):
 		'''
 		Specifically looks for "X" as the metal to be replaced
 		'''
-		result = []
-		for line in self.metal_ligand_list:
-			if line[0] == 'X':
-				result.append(line)
-		return result
+		return self.metal_ligand_list[self.metal_ligand_list.mask('X')]
 
 	def getLigands(self):
-		result = []
-		for line in self.metal_ligand_list:
-			if line[0] != 'X':
-				result.append(line)
+		return self.metal_ligand_list[~self.metal_ligand_list.mask('X')]
+
+	def getPlacements(self, ligands):
+		'''
+		Returns a dict of ligand to an (n_sites, n_atoms, 3) array of that
+		ligand placed and oriented on each of this mode's ligand sites.  Any
+		ligands not placed yet are placed together; see placeLigands
+		'''
+		missing = [lig for lig in set(ligands) if lig not in self._placements]
+		if missing:
+			placeLigands([self], missing)
+		return self._placements
+
+	def getSiteSignatures(self, scaffold_atoms, decimals=2):
+		'''
+		Returns a rotation and translation invariant signature for each ligand
+		site along with the matrix of rounded site-site distances.  A site's
+		signature is its rounded distance to the metal and the sorted rounded
+		distances to every scaffold atom, tagged by element.  Sites related by
+		a symmetry of the binding mode share a signature.  Cached per scaffold
+		atom list and number of decimals since it only depends on geometry.
+		'''
+		cached = self._siteSignatures.get(decimals)
+		if cached is not None and cached[0] is scaffold_atoms:
+			return cached[1]
+
+		metal = self.getMetal().coords[0]
+		sites = self.getLigands().coords
+		elements = scaffold_atoms.elements.tolist()
+		scaffold = scaffold_atoms.coords
+
+		toMetal = np.round(np.linalg.norm(sites - metal, axis=1), decimals)
+		toScaffold = np.linalg.norm(sites[:, None, :] - scaffold[None, :, :], 
+												axis=2)
+		toScaffold = np.round(toScaffold, decimals)
+		siteSite = np.round(np.linalg.norm(sites[:, None, :] - sites[None, :, :],
+												axis=2), decimals)
+
+		signatures = []
+		for i in range(len(sites)):
+			env = tuple(sorted(zip(elements, toScaffold[i].tolist())))
+			signatures.append((toMetal[i], env))
+
+		result = (signatures, siteSite.tolist())
+		self._siteSignatures[decimals] = (scaffold_atoms, result)
 		return result
 
+class BindingModeSet(object):
+	'''
+	A container of BindingModes loaded from one or more directories or files.
+	Directories are searched recursively for .com and .gjf files, which are
+	parsed concurrently and checked against the scaffold as they are loaded,
+	so a bad file fails the whole set immediately.  Threads are used by
+	default; processes=True sidesteps the GIL at the cost of not sharing the
+	ParseCache with workers.  Modes are kept in sorted path order and are also
+	bucketed by ligand number, ready for Clusterizer.makeModesHashTable.
+	'''
+	def __init__(self, sources, scaffold, workers=None, processes=False,
+						tolerance=0.01, cache=None, extensions=('.com', '.gjf')):
+		if isinstance(sources, str):
+			sources = [sources]
+		self.scaffold = scaffold
+		self.tolerance = tolerance
+		self.extensions = tuple(ext.lower() for ext in extensions)
+		self.paths = self.findFiles(sources)
+		with stats.stage('binding'):
+			self.modes = self.loadModes(self.paths, workers, processes, cache)
+
+		self.maxLigs = 0
+		self.byLigands = {}
+		for mode in self.modes:
+			ligNum = mode.getNumLigands()
+			self.maxLigs = max(self.maxLigs, ligNum)
+			self.byLigands.setdefault(ligNum, []).append(mode)
+
+	def findFiles(self, sources):
+		paths = []
+		for source in sources:
+			source = os.path.abspath(source)
+			if os.path.isdir(source):
+				for root, dirs, files in os.walk(source):
+					for name in files:
+						if os.path.splitext(name)[1].lower() in self.extensions:
+							paths.append(os.path.join(root, name))
+			else:
+				paths.append(source)
+		return sorted(set(paths))
+
+	def loadModes(self, paths, workers, processes, cache):
+		scaffoldAtoms = self.scaffold.atom_list
+		if workers == 1 or ThreadPoolExecutor is None or len(paths) < 2:
+			return [loadBindingMode(path, scaffoldAtoms, self.tolerance, cache)
+						for path in paths]
+
+		if processes:
+			executor = ProcessPoolExecutor(max_workers=workers)
+			cache = None
+		else:
+			executor = ThreadPoolExecutor(max_workers=workers)
+
+		try:
+			futures = [executor.submit(loadBindingMode, path, scaffoldAtoms,
+													self.tolerance, cache) for path in paths]
+			done, pending = wait(futures, return_when=FIRST_EXCEPTION)
+			for future in done:
+				if future.exception() is not None:
+					for each in pending:
+						each.cancel()
+					raise future.exception()
+			return [future.result() for future in futures]
+		finally:
+			executor.shutdown(wait=True)
+
+	def __iter__(self):
+		return iter(self.modes)
+
+	def __len__(self):
+		return len(self.modes)
+
+	def __getitem__(self, index):
+		return self.modes[index]
+
+	def getModes(self, ligand_num):
+		return list(self.byLigands.get(ligand_num, []))
+
+def loadBindingMode(path, scaffold_atoms, tolerance, cache=None):
+	'''
+	Loads and verifies a single BindingMode, naming the file in any error.
+	Module level so it can be sent to a process pool
+	'''
+	try:
+		return BindingMode(path, scaffold_atoms, cache=cache, tolerance=tolerance)
+	except ValueError:
+		raise
+	except Exception as e:
+		raise ValueError('Could not load binding mode %s: %s' % (path, e))
+
+class PlacementCache(object):
+	'''
+	A bounded LRU cache of placed ligand conformations, owned by one
+	Clusterizer and shared by the AbstractModes it builds.  Entries are keyed
+	on the BindingMode, scaffold and ligand tuple (plus the mixed and
+	symmetry flags and rotamer settings) and hold the conformations and
+	assignments built for them, with the binding mode's own label on the
+	metal, and the (sampled, pruned) rotamer counts of building them.  Every
+	metal and oxidation state using the same ligands on the same binding
+	mode then only swaps the metal label, sharing the cached, read only
+	coordinate arrays instead of placing the ligands again.
+
+	The keys hold the Ligand and BindingMode objects themselves, which are
+	placed once by the Clusterizer, so a new Clusterizer gets a new cache.
+	A pickled cache comes back empty.
+	'''
+	def __init__(self, maxsize=4096):
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			# Move to the most recently used end
+			del self._entries[key]
+			self._entries[key] = entry
+			return entry
+
+	def put(self, key, conformations, assignments, counts=(0, 0)):
+		for conformation in conformations:
+			conformation.coords.flags.writeable = False
+			conformation.frozen.flags.writeable = False
+		with self._lock:
+			self._entries[key] = (conformations, assignments, counts)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __getstate__(self):
+		return {'maxsize': self.maxsize}
+
+	def __setstate__(self, state):
+		self.__init__(state['maxsize'])
+
 class AbstractMode(object):
 	'''
 	A class to bind a particular Combination and BindingMode object to make it
 	easier to iterate upon all possible conformations and finally write to an
-	output file
+	output file.  Placed conformations are looked up in and added to cache,
+	a PlacementCache, when one is given
 	'''
-	def __init__(self, combo_obj, binding_obj, scaffold, mixed=True):
+	def __init__(self, combo_obj, binding_obj, scaffold, mixed=True, 
+						symmetry=True, rotamers=None, cache=None):
 		self.combo = combo_obj
 		self.bindingMode = binding_obj
 		self.scaffold = scaffold
+		self.symmetry = symmetry
+		self.rotamers = rotamers
+		self.placementCache = cache
+		self.scores = None
 		self.conformations = self._createConformers(self.combo, 
 													self.bindingMode, mixed)
 
+	@classmethod
+	def fromConformations(cls, combo_obj, binding_obj, scaffold, conformations,
+									assignments, symmetry=True, rotamers=None):
+		'''
+		Wraps conformations that were already built, e.g. by a worker
+		process, without placing any ligands again
+		'''
+		mode = cls.__new__(cls)
+		mode.combo = combo_obj
+		mode.bindingMode = binding_obj
+		mode.scaffold = scaffold
+		mode.symmetry = symmetry
+		mode.rotamers = rotamers
+		mode.placementCache = None
+		mode.scores = None
+		mode.conformations = list(conformations)
+		mode.assignments = list(assignments)
+		return mode
+
 	def _createConformers(self, combo, binding, mixed):
 		'''
-		Create all the various possible conformations.  Dynammic programming is
-		overkill but a good practice.  If ligands aren't mixed, don't need to
-		actually create conformational variety because of symmetry.
+		Create all the various possible conformations as a list of AtomTables
+		for the metal and ligands.  If ligands aren't mixed, don't need to
+		actually create conformational variety because of symmetry, so there
+		is only ever one.  The ligand to site order of each conformation is
+		kept in self.assignments.  With a RotamerSampler in self.rotamers,
+		each conformation is replaced by its viable rotamers.  Conformations
+		are shared through self.placementCache, if set, so only the metal
+		label is set per Combination.  The sampler's counts are added again on
+		a cache hit, so they do not depend on the cache.
 		'''
-		conformations = []
-		prevConfs = {}
+		ligandList = combo.ligands
+		rotamers = self.rotamers
+		cache = self.placementCache
+		key = (binding, self.scaffold, tuple(ligandList), mixed, self.symmetry,
+					rotamers.settings() if rotamers is not None else None)
+		entry = cache.get(key) if cache is not None else None
+		if entry is None:
+			if mixed:
+				assignments = list(self._mixedAssignments(ligandList, binding))
+			else:
+				assignments = [list(ligandList)]
+			conformations = [self._transformSameLigs(binding.metal_ligand_list, 
+									ligands) for ligands in assignments]
+			counts = (0, 0)
+			if rotamers is not None:
+				before = (rotamers.sampled, rotamers.pruned)
+				conformations, assignments = rotamers.sample(binding, 
+											self.scaffold, conformations, assignments)
+				counts = (rotamers.sampled - before[0], rotamers.pruned - before[1])
+			if cache is not None:
+				cache.put(key, conformations, assignments, counts)
+		else:
+			conformations, assignments, counts = entry
+			if rotamers is not None:
+				rotamers.addCounts(*counts)
 
-		initial = copy.deepcopy(binding.metal_ligand_list) # Create copy
-		initial = self._replaceMetal(combo, initial)
+		self.assignments = [list(ligands) for ligands in assignments]
+		label = self._replaceMetal(combo, binding.metal_ligand_list).elements[0]
+		if label == binding.metal_ligand_list.elements[0]:
+			return list(conformations)
+		return [conformation.replaceElement(0, label) 
+					for conformation in conformations]
 
-		ligandList = combo.ligands
+	def getLigandGroups(self, index=0):
+		'''
+		Returns an int array labelling each atom of a conformation with the
+		position of the ligand it belongs to, with -1 for the metal
+		'''
+		return ligandGroups(self.assignments[index])
 
-		if mixed:
-			# Remember to make use of the prevConfs dict for DP, like would be
-			# necessary for 2OH's and a hydride
-			conformations = self._transformMixedLigs()
-		else:
-			conformations = self._transformSameLigs(initial, ligandList)
-			
-		return conformations
+	def removeConformations(self, keep):
+		'''
+		Drops the conformations (and their assignments and scores) whose entry
+		in the boolean keep array is False
+		'''
+		self.conformations = [conf for conf, k in zip(self.conformations, keep) 
+										if k]
+		self.assignments = [ligs for ligs, k in zip(self.assignments, keep) 
+										if k]
+		if self.scores is not None:
+			self.scores = [score for score, k in zip(self.scores, keep) if k]
 
 	def _replaceMetal(self, combo, conf_list):
-		for elem in conf_list:
-			if 'X' in elem:
-				elem[0] = combo.metal.name
-				break
-		return conf_list
+		'''
+		Returns a new AtomTable with the first "X" replaced by the metal
+		'''
+		metals = np.flatnonzero(conf_list.mask('X'))
+		if len(metals) == 0:
+			return conf_list
+		return conf_list.replaceElement(metals[0], combo.metal.name)
 
 	def _transformSameLigs(self, coords, ligand_list):
-		conformation = []
-		conformation.append(list(coords[0]))
-		for i, lig in enumerate(ligand_list):
-			coord = np.array(coords[i+1][2:], dtype=np.float32)
-			ligCoords = [atom[1:] for atom in lig.atom_list]
-			ligCoords = np.array(ligCoords)
-			ligCoords = coord + ligCoords
-			newLig = self._prependAtomInfo(lig, ligCoords)
-			for each in newLig:
-				conformation.append(each)
-
-		return conformation
-
-	def _prependAtomInfo(self, ligand, coords):
-		atoms = []
-		for atom, coord in zip(ligand.atom_list, coords.tolist()):
-			newAtom = []
-			newAtom.append(str(atom[0]))
-			newAtom.append('0')
-			for i in range(3):
-				newAtom.append(str(coord[i]))
-				
-			atoms.append(newAtom)
-		
-		return atoms
-			
-	
-	def _transformMixedLigs(self):
-		print("I'm not defined yet!")
-		sys.exit()
+		'''
+		Returns an AtomTable of the metal followed by each ligand on its site,
+		taken from the binding mode's batched placements
+		'''
+		if len(ligand_list) == 0:
+			return coords[:1]
+
+		placements = self.bindingMode.getPlacements(ligand_list)
+		blocks = [placements[lig][i] for i, lig in enumerate(ligand_list)]
+		elements = np.concatenate([lig.atom_list.elements for lig in ligand_list])
+		placed = AtomTable(elements, np.zeros(len(elements)), 
+									np.concatenate(blocks))
+
+		return AtomTable.concatenate([coords[:1], placed])
+
+	def _mixedAssignments(self, ligand_list, binding):
+		'''
+		Yields every distinct ordering of the ligands over the binding mode's
+		ligand sites.  Identical ligands are never swapped with one another,
+		and with symmetry on, orderings whose fingerprint matches one already
+		seen are skipped because they are the same structure under a symmetry
+		of the binding mode
+		'''
+		prevConfs = {}
+		if self.symmetry:
+			signatures, siteSite = binding.getSiteSignatures(
+																self.scaffold.atom_list)
+
+		for ligands in uniquePermutations(ligand_list):
+			if self.symmetry:
+				fingerprint = self._assignmentFingerprint(ligands, signatures, 
+																		siteSite)
+				if fingerprint in prevConfs:
+					continue
+				prevConfs[fingerprint] = ligands
+			yield ligands
+
+	def _assignmentFingerprint(self, ligands, signatures, site_site):
+		'''
+		Canonical fingerprint of a ligand to site assignment.  Each site
+		contributes its ligand, its signature and the sorted distances to the
+		other ligands, so any permutation of sites that preserves the binding
+		mode geometry gives the same fingerprint
+		'''
+		names = [lig.name for lig in ligands]
+		sites = []
+		for i, name in enumerate(names):
+			others = sorted((names[j], site_site[i][j]) 
+									for j in range(len(names)) if j != i)
+			sites.append((name, signatures[i], tuple(others)))
+		return tuple(sorted(sites))
+
+class ConformerStore(object):
+	'''
+	Holds the conformations of many AbstractModes in a few contiguous arrays
+	instead of one AtomTable per conformation.  Every atom has a row in the
+	coordinate, frozen flag and element code arrays, conformations are
+	offsets into them, and each mode is a range of conformations with the
+	indices of its Combination and BindingMode.  Element labels,
+	Combinations, BindingModes and ligands are interned once into short
+	lists.  Appended modes are packed into compact arrays every chunk_size
+	modes, so the per-conformation objects of a mode are released soon
+	after it is appended, and the packed chunks are joined onto the arrays
+	the first time they are read.
+
+	The store is a sequence of StoredMode views, which carry the combo,
+	bindingMode, scaffold and conformations of an AbstractMode, so writers
+	and filters work on them unchanged.  Their conformations are AtomTables
+	over slices of the shared arrays.  Removing conformations only clears
+	them in a mask.
+	'''
+	def __init__(self, scaffold, chunk_size=256):
+		self.scaffold = scaffold
+		self.chunkSize = chunk_size
+		self.labels, self.combos, self.bindings, self.ligands = [], [], [], []
+		self._labelIndex, self._comboIndex = {}, {}
+		self._bindingIndex, self._ligandIndex = {}, {}
+
+		self.coords = np.zeros((0, 3))
+		self.frozen = np.zeros(0, dtype=np.int8)
+		self.codes = np.zeros(0, dtype=np.int16)
+		self.offsets = np.zeros(1, dtype=np.int64)
+		self.ligandCodes = np.zeros(0, dtype=np.int32)
+		self.ligandOffsets = np.zeros(1, dtype=np.int64)
+		self.alive = np.zeros(0, dtype=bool)
+		self.scores = np.zeros(0)
+		self.modeCombo = np.zeros(0, dtype=np.int32)
+		self.modeBinding = np.zeros(0, dtype=np.int32)
+		self.modeSymmetry = np.zeros(0, dtype=bool)
+		self.modeOffsets = np.zeros(1, dtype=np.int64)
+		self._labelArray = np.zeros(0, dtype=str)
+		self._pending = None
+		self._packed = []
+
+	@classmethod
+	def fromModes(cls, absModes, scaffold=None):
+		store = None
+		for mode in absModes:
+			if store is None:
+				store = cls(scaffold if scaffold is not None else mode.scaffold)
+			store.append(mode)
+		if store is None:
+			store = cls(scaffold)
+		store._consolidate()
+		return store
+
+	def _intern(self, values, index, item):
+		if item not in index:
+			index[item] = len(values)
+			values.append(item)
+		return index[item]
+
+	def append(self, mode):
+		'''
+		Copy the conformations of an AbstractMode (or StoredMode) into the
+		store
+		'''
+		if self._pending is None:
+			self._pending = dict((name, []) for name in ('coords', 'frozen', 
+								'codes', 'sizes', 'ligandCodes', 'ligandSizes', 'scores',
+								'modes'))
+		pending = self._pending
+		for conformation, ligands in zip(mode.conformations, mode.assignments):
+			labels, inverse = np.unique(conformation.elements, return_inverse=True)
+			lookup = np.array([self._intern(self.labels, self._labelIndex, 
+								str(label)) for label in labels],
+									dtype=np.int16)
+			pending['codes'].append(lookup[inverse.reshape(-1)])
+			pending['coords'].append(conformation.coords)
+			pending['frozen'].append(conformation.frozen)
+			pending['sizes'].append(len(conformation))
+			pending['ligandCodes'].append([self._intern(self.ligands, 
+								self._ligandIndex, lig) for lig in ligands])
+			pending['ligandSizes'].append(len(ligands))
+		scores = getattr(mode, 'scores', None)
+		if scores is None:
+			scores = [np.nan]*len(mode.conformations)
+		pending['scores'].append(scores)
+		pending['modes'].append((
+							self._intern(self.combos, self._comboIndex, mode.combo),
+							self._intern(self.bindings, self._bindingIndex, mode.bindingMode),
+							mode.symmetry, len(mode.conformations)))
+		if len(pending['modes']) >= self.chunkSize:
+			self._pack()
+
+	def _pack(self):
+		'''
+		Turns the pending conformations into one chunk of flat arrays
+		'''
+		pending, self._pending = self._pending, None
+		if pending is None:
+			return
+		def flat(chunks, dtype, shape=()):
+			return np.concatenate([np.zeros((0,) + shape, dtype=dtype)] + 
+									[np.asarray(c, dtype=dtype).reshape((-1,) + shape) 
+										for c in chunks])
+		modes = pending['modes']
+		self._packed.append({
+			'coords': flat(pending['coords'], np.float64, (3,)),
+			'frozen': flat(pending['frozen'], np.int8),
+			'codes': flat(pending['codes'], np.int16),
+			'sizes': np.asarray(pending['sizes'], dtype=np.int64),
+			'ligandCodes': flat(pending['ligandCodes'], np.int32),
+			'ligandSizes': np.asarray(pending['ligandSizes'], dtype=np.int64),
+			'scores': flat(pending['scores'], np.float64),
+			'modeCombo': np.array([m[0] for m in modes], dtype=np.int32),
+			'modeBinding': np.array([m[1] for m in modes], dtype=np.int32),
+			'modeSymmetry': np.array([m[2] for m in modes], dtype=bool),
+			'modeSizes': np.array([m[3] for m in modes], dtype=np.int64)})
+
+	def _consolidate(self):
+		self._pack()
+		packed, self._packed = self._packed, []
+		if not packed:
+			return
+		def join(array, name):
+			return np.concatenate([array] + [chunk[name] for chunk in packed])
+		def extend(offsets, name):
+			sizes = np.concatenate([chunk[name] for chunk in packed])
+			return np.concatenate([offsets, offsets[-1] + np.cumsum(sizes)])
+
+		self.coords = join(self.coords, 'coords')
+		self.frozen = join(self.frozen, 'frozen')
+		self.codes = join(self.codes, 'codes')
+		self.offsets = extend(self.offsets, 'sizes')
+		self.ligandCodes = join(self.ligandCodes, 'ligandCodes')
+		self.ligandOffsets = extend(self.ligandOffsets, 'ligandSizes')
+		self.alive = np.concatenate([self.alive] + [np.ones(len(chunk['sizes']),
+										dtype=bool) for chunk in packed])
+		self.scores = join(self.scores, 'scores')
+		self.modeCombo = join(self.modeCombo, 'modeCombo')
+		self.modeBinding = join(self.modeBinding, 'modeBinding')
+		self.modeSymmetry = join(self.modeSymmetry, 'modeSymmetry')
+		self.modeOffsets = extend(self.modeOffsets, 'modeSizes')
+		self._labelArray = np.array(self.labels, dtype=str)
+
+	def __len__(self):
+		self._consolidate()
+		return len(self.modeCombo)
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError('ConformerStore index out of range')
+		return StoredMode(self, index)
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield StoredMode(self, index)
+
+	def numConformations(self):
+		self._consolidate()
+		return int(np.count_nonzero(self.alive))
+
+	def conformationIndices(self, mode_index):
+		'''
+		Returns the indices of the mode's conformations that are still alive
+		'''
+		self._consolidate()
+		start, end = self.modeOffsets[mode_index], self.modeOffsets[mode_index+1]
+		return start + np.flatnonzero(self.alive[start:end])
+
+	def conformation(self, conf_index):
+		'''
+		Returns a conformation as an AtomTable sharing the store's arrays
+		'''
+		start, end = self.offsets[conf_index], self.offsets[conf_index+1]
+		return AtomTable(self._labelArray[self.codes[start:end]], 
+								self.frozen[start:end], self.coords[start:end])
+
+	def assignment(self, conf_index):
+		start = self.ligandOffsets[conf_index]
+		end = self.ligandOffsets[conf_index+1]
+		return [self.ligands[i] for i in self.ligandCodes[start:end]]
+
+	def remove(self, mode_index, keep):
+		'''
+		Drops the mode's alive conformations whose entry in keep is False
+		'''
+		indices = self.conformationIndices(mode_index)
+		self.alive[indices[~np.asarray(keep, dtype=bool)]] = False
+
+class StoredMode(object):
+	'''
+	A lightweight view of one mode in a ConformerStore, standing in for an
+	AbstractMode
+	'''
+	__slots__ = ('store', 'index')
+
+	def __init__(self, store, index):
+		self.store = store
+		self.index = index
+
+	@property
+	def combo(self):
+		return self.store.combos[self.store.modeCombo[self.index]]
+
+	@property
+	def bindingMode(self):
+		return self.store.bindings[self.store.modeBinding[self.index]]
+
+	@property
+	def scaffold(self):
+		return self.store.scaffold
+
+	@property
+	def symmetry(self):
+		return bool(self.store.modeSymmetry[self.index])
+
+	@property
+	def conformations(self):
+		return [self.store.conformation(i) 
+					for i in self.store.conformationIndices(self.index)]
+
+	@property
+	def assignments(self):
+		return [self.store.assignment(i) 
+					for i in self.store.conformationIndices(self.index)]
+
+	@property
+	def scores(self):
+		scores = self.store.scores[self.store.conformationIndices(self.index)]
+		if np.isnan(scores).all():
+			return None
+		return scores.tolist()
+
+	@scores.setter
+	def scores(self, scores):
+		self.store.scores[self.store.conformationIndices(self.index)] = scores
+
+	def getLigandGroups(self, index=0):
+		conf = self.store.conformationIndices(self.index)[index]
+		return ligandGroups(self.store.assignment(conf))
+
+	def removeConformations(self, keep):
+		self.store.remove(self.index, keep)
+
+class _Species(object):
+	'''
+	A stand in ligand with only a name, for counting assignments
+	'''
+	__slots__ = ('name',)
+
+	def __init__(self, name):
+		self.name = name
+
+def countAssignments(binding, scaffold, pattern, symmetry=True, cache=None):
+	'''
+	Returns the number of conformations AbstractMode builds on a binding
+	mode for a ligand multiset whose distinct ligands appear pattern[i]
+	times.  Without symmetry, or when no two sites share a signature, every
+	ordering is distinct and this is the multinomial coefficient.  Otherwise
+	the count only depends on which site signatures and site-site distances
+	are equal, so it is found by running the usual assignment search over
+	stand in ligands, once for each such structure when a cache dict is
+	given
+	'''
+	total = math.factorial(sum(pattern))
+	for count in pattern:
+		total //= math.factorial(count)
+	if len(pattern) < 2 or not symmetry:
+		return total
+	signatures, siteSite = binding.getSiteSignatures(scaffold.atom_list)
+	if len(set(signatures)) == len(signatures):
+		return total
+
+	key = (_relabel(signatures), _relabel(value for row in siteSite 
+						for value in row), tuple(pattern))
+	if cache is not None and key in cache:
+		return cache[key]
+	ligands = []
+	for i, count in enumerate(pattern):
+		ligands.extend([_Species('L%d' % i)]*count)
+	mode = AbstractMode.__new__(AbstractMode)
+	mode.scaffold = scaffold
+	mode.symmetry = symmetry
+	total = sum(1 for _ in mode._mixedAssignments(ligands, binding))
+	if cache is not None:
+		cache[key] = total
+	return total
+
+def _relabel(values):
+	'''
+	Replaces each value by the order in which it first appears, keeping only
+	which values are equal
+	'''
+	labels = {}
+	return tuple(labels.setdefault(value, len(labels)) for value in values)
+
+def ligandGroups(ligands):
+	'''
+	Returns an int array labelling each atom of a conformation built from
+	the metal and ligands with the position of its ligand, -1 for the metal
+	'''
+	sizes = [len(lig.atom_list) for lig in ligands]
+	groups = np.repeat(np.arange(len(sizes)), sizes)
+	return np.concatenate([[-1], groups]).astype(np.int64)
+
+def uniquePermutations(items):
+	'''
+	Yields every distinct ordering of a multiset exactly once.  Items are
+	grouped by identity, so identical ligands are never permuted with each
+	other and n identical items give a single ordering instead of n!
+	'''
+	distinct = []
+	counts = []
+	for item in items:
+		for i, seen in enumerate(distinct):
+			if seen is item:
+				counts[i] += 1
+				break
+		else:
+			distinct.append(item)
+			counts.append(1)
+
+	result = [None]*len(items)
+
+	def permute(depth):
+		if depth == len(result):
+			yield list(result)
+			return
+		for i, item in enumerate(distinct):
+			if counts[i] == 0:
+				continue
+			counts[i] -= 1
+			result[depth] = item
+			for perm in permute(depth+1):
+				yield perm
+			counts[i] += 1
+
+	return permute(0)
+
+def placeLigands(binding_list, ligands):
+	'''
+	Orients and places every ligand on every ligand site of every binding
+	mode.  Each ligand's head to tail vector is aligned with the metal to site
+	vector, so the tail points away from the metal, and the head is moved onto
+	the site.  All of the rotation matrices are built in one stacked call and
+	each ligand is applied to all sites with a single einsum.  The results
+	are stored on the binding modes; see BindingMode.getPlacements
+	'''
+	with stats.stage('placement'):
+		_placeLigands(list(binding_list), list(ligands))
+
+def _siteArrays(binding_list):
+	'''
+	Returns the stacked ligand sites of the binding modes, the metal
+	position repeated for each site and the bounds of each mode's sites
+	'''
+	sites, metals, bounds = [], [], [0]
+	for binding in binding_list:
+		siteCoords = binding.getLigands().coords
+		metal = binding.getMetal().coords[:1]
+		sites.append(siteCoords)
+		metals.append(np.repeat(metal, len(siteCoords), axis=0))
+		bounds.append(bounds[-1] + len(siteCoords))
+	sites = np.concatenate(sites).reshape(-1, 3)
+	metals = np.concatenate(metals).reshape(-1, 3)
+	return sites, metals, bounds
+
+def _placeLigands(binding_list, ligands):
+	sites, metals, bounds = _siteArrays(binding_list)
+	numSites = len(sites)
+
+	axes = np.array([lig.getAxis() for lig in ligands]).reshape(-1, 3)
+	rotations = alignmentMatrices(np.repeat(axes, numSites, axis=0),
+											np.tile(sites - metals, (len(ligands), 1)))
+	rotations = rotations.reshape(len(ligands), numSites, 3, 3)
+
+	for l, lig in enumerate(ligands):
+		placed = applyRotations(rotations[l], lig.getLocalCoords())
+		placed += sites[:, None, :]
+		for b, binding in enumerate(binding_list):
+			binding._placements[lig] = placed[bounds[b]:bounds[b+1]]
+
+def placeRotamers(binding_list, ligands, count, tolerance=1e-3):
+	'''
+	Places count rotamers of every ligand on every ligand site of every
+	binding mode, turning the placed ligand about the metal to site axis by
+	multiples of 2pi/count.  The rotations of all sites are built in one
+	stacked call and applied to each ligand with a single einsum.  Rotamer 0
+	is the placement itself, and ligands with no atom further than tolerance
+	from the axis keep only that one.  The (sites, rotamers, atoms, 3)
+	arrays are stored on the binding modes; see RotamerSampler
+	'''
+	binding_list = list(binding_list)
+	ligands = list(ligands)
+	for binding in binding_list:
+		binding.getPlacements(ligands)
+
+	with stats.stage('placement'):
+		sites, metals, bounds = _siteArrays(binding_list)
+		axes = normalize(sites - metals)
+		rotations = axisRotations(axes, 2*np.pi*np.arange(count)/count)
+
+		for lig in ligands:
+			placed = np.concatenate([binding._placements[lig] 
+												for binding in binding_list])
+			local = placed - sites[:, None, :]
+			along = np.einsum('saj,sj->sa', local, axes)
+			offAxis = np.linalg.norm(local - along[..., None]*axes[:, None, :], 
+												axis=-1)
+			if count > 1 and offAxis.size and offAxis.max() > tolerance:
+				rotated = np.einsum('skij,saj->skai', rotations, local)
+				rotated += sites[:, None, None, :]
+				rotated[:, 0] = placed
+			else:
+				rotated = placed[:, None]
+			for b, binding in enumerate(binding_list):
+				binding._rotamers[(lig, count, tolerance)] = \
+															rotated[bounds[b]:bounds[b+1]]
+
+class RotamerSampler(object):
+	'''
+	Adds rotamers to the conformations of AbstractModes.  Each placed ligand
+	is turned about its metal to head axis by count evenly spaced angles,
+	starting from its usual orientation, and every combination of the
+	ligands' rotamers is a rotor state of the conformation.  When there are
+	more than max_states of them, max_states states spread evenly over all
+	of them are used, always including the unrotated one.
+
+	Every state is checked for clashes with the scaffold and between
+	ligands in one array call (see ClashFilter.checkCoords), and only the
+	viable ones are kept.  A conformation with no viable state is dropped.
+	Ligands with all of their atoms on the axis, like OH or single atoms,
+	only have the one rotamer.  Pass the sampler to Clusterizer(rotamers=)
+	so the rotamers of every mode are placed together; see placeRotamers
+	'''
+	def __init__(self, count=6, max_states=64, scale=0.7, check_ligands=True,
+						tolerance=1e-3):
+		self.count = count
+		self.maxStates = max_states
+		self.scale = scale
+		self.checkLigands = check_ligands
+		self.tolerance = tolerance
+		self._clashFilters = {}
+
+		self.sampled = 0
+		self.pruned = 0
+
+	def settings(self):
+		'''
+		Returns a tuple of the parameters that decide which rotamers are kept,
+		used in cache and OutputManifest keys
+		'''
+		return (type(self).__name__, self.count, self.maxStates, self.scale,
+					self.checkLigands, self.tolerance)
+
+	def rotamerCounts(self, binding_list, ligands):
+		'''
+		Returns a dict of each ligand to its number of rotamers, which
+		placeRotamers gives it on every site of every binding mode
+		'''
+		for binding in binding_list:
+			rotamers = self.getRotamers(binding, ligands)
+			return dict((lig, rotamers[lig].shape[1]) for lig in ligands)
+		return dict((lig, 1) for lig in ligands)
+
+	def clashFilter(self, scaffold):
+		clashFilter = self._clashFilters.get(scaffold)
+		if clashFilter is None:
+			clashFilter = self._clashFilters[scaffold] = ClashFilter(scaffold,
+															self.scale, self.checkLigands)
+		return clashFilter
+
+	def getRotamers(self, binding, ligands):
+		'''
+		Returns a dict of ligand to its (sites, rotamers, atoms, 3) array on a
+		binding mode, placing any that are missing
+		'''
+		key = lambda lig: (lig, self.count, self.tolerance)
+		missing = [lig for lig in set(ligands) if key(lig) not in binding._rotamers]
+		if missing:
+			placeRotamers([binding], missing, self.count, self.tolerance)
+		return dict((lig, binding._rotamers[key(lig)]) for lig in set(ligands))
+
+	def states(self, counts):
+		'''
+		Returns an (n, len(counts)) array of the rotamer index of each ligand
+		in each rotor state
+		'''
+		total = 1
+		for count in counts:
+			total *= count
+		if total <= self.maxStates:
+			flat = np.arange(total)
+		else:
+			flat = np.unique(np.rint(np.linspace(0, total - 1, 
+															self.maxStates)).astype(np.int64))
+		return np.stack(np.unravel_index(flat, counts), axis=1)
+
+	def sample(self, binding, scaffold, conformations, assignments):
+		'''
+		Returns the viable rotamers of a binding mode's conformations and their
+		ligand assignments, each conformation's rotamers in state order.  The
+		states of all of the conformations are checked in one call
+		'''
+		if not conformations or not assignments[0]:
+			return conformations, assignments
+
+		coords, elements, groups, owners, rotated = [], [], [], [], []
+		for c, (conf, ligands) in enumerate(zip(conformations, assignments)):
+			rotamers = self.getRotamers(binding, ligands)
+			blocks = [rotamers[lig][i] for i, lig in enumerate(ligands)]
+			states = self.states([len(block) for block in blocks])
+			coords.append(np.concatenate([block[states[:, i]] 
+													for i, block in enumerate(blocks)], axis=1))
+			shape = coords[-1].shape[:2]
+			elements.append(np.broadcast_to(conf.elements[1:], shape))
+			groups.append(np.broadcast_to(ligandGroups(ligands)[1:], shape))
+			owners.append(np.full(len(states), c))
+			rotated.append(states.any(axis=1))
+		coords = np.concatenate(coords)
+		keep = self.clashFilter(scaffold).checkCoords(coords,
+										np.concatenate(elements), np.concatenate(groups))
+		owners = np.concatenate(owners)
+		rotated = np.concatenate(rotated)
+
+		self.addCounts(len(keep), int(np.count_nonzero(~keep)))
+
+		confs, assigned = [], []
+		for i in np.flatnonzero(keep):
+			conf = conformations[owners[i]]
+			if rotated[i]:
+				conf = AtomTable(conf.elements, conf.frozen, 
+										np.concatenate([conf.coords[:1], coords[i]]))
+			confs.append(conf)
+			assigned.append(list(assignments[owners[i]]))
+		return confs, assigned
+
+	def addCounts(self, sampled, pruned):
+		'''
+		Adds to the rotamers sampled and pruned, e.g. the counts a worker
+		process sends back
+		'''
+		self.sampled += sampled
+		self.pruned += pruned
+		stats.count('rotamersPruned', pruned)
+
+	def report(self):
+		return {'sampled': self.sampled, 'pruned': self.pruned}
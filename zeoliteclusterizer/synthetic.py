@@ -0,0 +1,152 @@
+import os
+import numpy as np
+from extraframework import Metal, Ligand, hydroxide, hydride, oxide
+
+'''
+Generators for synthetic screening inputs of any size, used by the
+benchmarks.  Scaffolds are rings of T sites (Si with one Al) bridged by
+oxygens and capped with frozen hydrogens, written as Gaussian inputs like
+the ones in tests/.  Binding modes add an "X" metal over the ring and its
+ligand sites on the far side from the ring.  Everything is seeded, so the
+same arguments always give the same files.
+'''
+
+header = '# opt freq ub3lyp/6-31+g(d) empiricaldispersion=gd3'
+
+metal_states = [('Sc', [1, 3]), ('Ti', [2, 4]), ('V', [1, 3, 5]),
+						('Cr', [2, 3, 6]), ('Mn', [2, 4, 7]), ('Fe', [2, 3]),
+						('Co', [2, 3]), ('Ni', [2]), ('Cu', [1, 2]), ('Zn', [2]),
+						('Y', [3]), ('Zr', [4]), ('Nb', [3, 5]), ('Mo', [4, 6]),
+						('Ru', [2, 3, 4]), ('Rh', [1, 3]), ('Pd', [2, 4]),
+						('Ag', [1]), ('Cd', [2]), ('Hf', [4]), ('Ta', [5]),
+						('W', [4, 6]), ('Re', [3, 7]), ('Os', [4, 8]), ('Ir', [1, 3]),
+						('Pt', [2, 4]), ('Au', [1, 3]), ('Hg', [1, 2])]
+
+extra_ligands = [
+	Ligand('F', [['F', 0.0, 0.0, 0.0]], [-1], [0]),
+	Ligand('Cl', [['Cl', 0.0, 0.0, 0.0]], [-1], [0]),
+	Ligand('H2O', [['O', 0.0, 0.0, 0.0], ['H', 0.76, 0.0, -0.59],
+						['H', -0.76, 0.0, -0.59]], [0], [0]),
+	Ligand('NH2', [['N', 0.0, 0.0, 0.0], ['H', 0.80, 0.0, -0.60],
+						['H', -0.80, 0.0, -0.60]], [-1], [0]),
+	Ligand('NH3', [['N', 0.0, 0.0, 0.0], ['H', 0.94, 0.0, -0.38],
+						['H', -0.47, 0.81, -0.38], ['H', -0.47, -0.81, -0.38]], [0], [0]),
+	Ligand('CH3', [['C', 0.0, 0.0, 0.0], ['H', 1.03, 0.0, -0.36],
+						['H', -0.51, 0.89, -0.36], ['H', -0.51, -0.89, -0.36]], [-1], [0]),
+	Ligand('OMe', [['O', 0.0, 0.0, 0.0], ['C', 0.0, 0.0, -1.42],
+						['H', 1.03, 0.0, -1.78], ['H', -0.51, 0.89, -1.78],
+						['H', -0.51, -0.89, -1.78]], [-1], [0]),
+	Ligand('CO', [['C', 0.0, 0.0, 0.0], ['O', 0.0, 0.0, -1.13]], [0], [0]),
+]
+
+def ringAtoms(num_atoms, seed=0):
+	'''
+	Returns rows of [element, frozen, x, y, z] for a ring scaffold of about
+	num_atoms atoms.  A ring of n T sites has n bridging oxygens and two
+	hydrogen caps per T site, so n is chosen to come closest
+	'''
+	rng = np.random.RandomState(seed)
+	numT = max(3, int(round(num_atoms / 4.0)))
+	radius = 3.1 / (2*np.sin(np.pi/numT))
+	rows = []
+	for i in range(numT):
+		angle = 2*np.pi*(i + 0.5)/numT
+		rows.append(['O', 0] + list(1.1*radius*np.array([np.cos(angle),
+								np.sin(angle), 0.0]) + rng.normal(0, 0.05, 3)))
+	sites = []
+	for i in range(numT):
+		angle = 2*np.pi*i/numT
+		site = radius*np.array([np.cos(angle), np.sin(angle), 0.0]) + \
+					rng.normal(0, 0.05, 3)
+		sites.append(site)
+		rows.append(['Al' if i == numT - 1 else 'Si', 0] + list(site))
+	for site in sites:
+		outward = site / np.linalg.norm(site)
+		for z in (1.0, -1.0):
+			cap = site + 1.2*outward + np.array([0.0, 0.0, z])
+			rows.append(['H', -1] + list(cap))
+	return rows
+
+def writeInput(path, rows, charge=0, mult=1, title=header):
+	'''
+	Write rows of [element, frozen, x, y, z] as a Gaussian input
+	'''
+	lines = [title, '', 'Title Card Required', '', '%d %d' % (charge, mult)]
+	for element, frozen, x, y, z in rows:
+		lines.append(' %-16s%-4d%14.8f%14.8f%14.8f' % (element, frozen, x, y, z))
+	lines.extend(['', '', ''])
+	with open(path, 'w') as outfile:
+		outfile.write('\n'.join(lines))
+	return path
+
+def writeScaffold(path, num_atoms=24, seed=0):
+	'''
+	Write a synthetic ring scaffold, returning its path and atom rows
+	'''
+	rows = ringAtoms(num_atoms, seed)
+	writeInput(path, rows, charge=-1, mult=1)
+	return path, rows
+
+def writeBindingModes(directory, scaffold_rows, num_files=10, max_sites=3,
+								seed=0):
+	'''
+	Write num_files binding modes over a scaffold into directory, with 0 to
+	max_sites ligand sites each.  Returns the list of paths
+	'''
+	rng = np.random.RandomState(seed)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	coords = np.array([row[2:] for row in scaffold_rows], dtype=np.float64)
+	center = coords.mean(axis=0)
+
+	paths = []
+	for i in range(num_files):
+		numSites = i % (max_sites + 1)
+		metal = center + np.array([rng.uniform(-1.0, 1.0), rng.uniform(-1.0, 1.0),
+												rng.uniform(1.5, 2.5)])
+		rows = list(scaffold_rows) + [['X', 0] + list(metal)]
+		for _ in range(numSites):
+			# Sites point away from the ring
+			direction = rng.normal(0, 1, 3)
+			direction[2] = abs(direction[2]) + 0.5
+			direction /= np.linalg.norm(direction)
+			rows.append(['H', 0] + list(metal + 2.0*direction))
+		path = os.path.join(directory, 'binding%d_%dlig.com' % (i + 1, numSites))
+		paths.append(writeInput(path, rows, charge=0, mult=2))
+	return paths
+
+def makeMetals(count):
+	'''
+	Returns count Metals with their common oxidation states, reusing the
+	list with numbered names if more are asked for than it holds
+	'''
+	metals = []
+	for i in range(count):
+		name, charges = metal_states[i % len(metal_states)]
+		if i >= len(metal_states):
+			name = '%s%d' % (name, i // len(metal_states))
+		metals.append(Metal(name, charges, [0]))
+	return metals
+
+def makeLigands(count):
+	'''
+	Returns count Ligands, starting with the common ligands in
+	extraframework
+	'''
+	ligands = [hydroxide, hydride, oxide] + extra_ligands
+	if count > len(ligands):
+		raise ValueError('Only %d synthetic ligands are available' % len(ligands))
+	return ligands[:count]
+
+def makeScreen(directory, num_atoms=24, num_modes=12, max_sites=3, seed=0):
+	'''
+	Write a synthetic scaffold and binding modes into directory, returning
+	the scaffold path and the list of binding mode paths
+	'''
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	scaffold, rows = writeScaffold(os.path.join(directory, 'scaffold.com'),
+												num_atoms, seed)
+	modes = writeBindingModes(os.path.join(directory, 'binding_sites'), rows,
+										num_modes, max_sites, seed)
+	return scaffold, modes
@@ -0,0 +1,30 @@
+import os
+import sys
+import pytest
+
+tests = os.path.dirname(os.path.abspath(__file__))
+# The modules import each other by their top level names
+sys.path.insert(0, os.path.dirname(tests))
+
+from scaffolds import BindingMode, ScaffoldRing
+from extraframework import Metal, hydride, hydroxide, oxide
+
+@pytest.fixture(scope='session')
+def scaffold():
+	return ScaffoldRing(os.path.join(tests, 'optimized_ring',
+										'optimized_ring.com'))
+
+@pytest.fixture(scope='session')
+def modes(scaffold):
+	modesDir = os.path.join(tests, 'binding_sites')
+	return [BindingMode(os.path.join(modesDir, name), scaffold.atom_list)
+				for name in sorted(os.listdir(modesDir))]
+
+@pytest.fixture
+def metals():
+	return [Metal('Sc', [1, 3], [0]), Metal('Ti', [2, 4], [0]),
+				Metal('V', [1, 3, 5], [0])]
+
+@pytest.fixture
+def ligands():
+	return [hydroxide, hydride, oxide]
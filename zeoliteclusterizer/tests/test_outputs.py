@@ -0,0 +1,105 @@
+import os
+import pytest
+from clusterizer import Clusterizer
+from filters import ClashFilter, DuplicateFilter, ScoreFilter
+from gaussian import G09ArchiveOutput, G09Output
+from scaffolds import BindingMode
+
+def readTree(directory, stale=()):
+	'''
+	Returns a dict of every file's path relative to directory to its bytes,
+	leaving out the resume manifest and the given stale files
+	'''
+	tree = {}
+	for root, _, names in os.walk(directory):
+		for name in names:
+			path = os.path.join(root, name)
+			if name != 'manifest.json' and \
+					os.path.relpath(path, directory) not in stale:
+				with open(path, 'rb') as infile:
+					tree[os.path.relpath(path, directory)] = infile.read()
+	return tree
+
+def writeScreen(directory, clusterizer, **kwargs):
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	G09Output(directory).writeAllModes(clusterizer.iterModes(), **kwargs)
+	return readTree(directory)
+
+def writeResumed(directory, clusterizer):
+	output = G09Output(directory, resume=True)
+	output.writeAllModes(clusterizer.iterModes(manifest=output.manifest),
+								makedirs=True)
+	return output
+
+def testShardsMatchSingleRun(tmpdir, scaffold, modes, metals, ligands):
+	single = writeScreen(str(tmpdir.join('single')),
+								Clusterizer(scaffold, modes, metals, ligands, lazy=True))
+	sharded = str(tmpdir.join('sharded'))
+	for index in range(3):
+		clusterizer = Clusterizer(scaffold, modes, metals, ligands, lazy=True,
+											shard=(index, 3))
+		writeScreen(sharded, clusterizer)
+	assert single
+	assert readTree(sharded) == single
+
+@pytest.mark.parametrize('lazy', [True, False])
+def testWorkersMatchSerial(tmpdir, scaffold, modes, metals, ligands, lazy):
+	serial = Clusterizer(scaffold, modes, metals, ligands, lazy=lazy)
+	parallel = Clusterizer(scaffold, modes, metals, ligands, lazy=lazy,
+									workers=2, chunksize=2)
+	expected = str(tmpdir.join('serial'))
+	os.makedirs(expected)
+	G09Output(expected).writeAllModes(serial.getFinalModes())
+	written = str(tmpdir.join('parallel'))
+	os.makedirs(written)
+	G09Output(written).writeAllModes(parallel.getFinalModes())
+	assert readTree(written) == readTree(expected)
+
+@pytest.mark.parametrize('makeFilters', [
+	lambda scaffold: [ClashFilter(scaffold, scale=0.5)],
+	lambda scaffold: [ClashFilter(scaffold), DuplicateFilter(scaffold)],
+	lambda scaffold: [ScoreFilter(scaffold, top=3)],
+	lambda scaffold: [ScoreFilter(scaffold, top=5, per='metal')],
+])
+def testResumeMatchesFullRun(tmpdir, scaffold, modes, metals, ligands,
+										makeFilters):
+	# The copies give DuplicateFilter something to remove
+	copies = [BindingMode(mode.input_loc, scaffold.atom_list) for mode in modes]
+	def clusterizer(metals, modes):
+		return Clusterizer(scaffold, modes, metals, ligands, lazy=True,
+									filters=makeFilters(scaffold))
+
+	resumed = str(tmpdir.join('resumed'))
+	os.makedirs(resumed)
+	writeResumed(resumed, clusterizer(metals[:2], modes[:-1]))
+	stale = writeResumed(resumed, clusterizer(metals, modes[:-1] + copies)).stale
+	full = writeScreen(str(tmpdir.join('full')),
+								clusterizer(metals, modes[:-1] + copies), makedirs=True)
+	# Files the first run wrote that the full run doesn't are only reported
+	assert not set(stale) & set(full)
+	assert readTree(resumed, stale) == full
+
+	output = writeResumed(resumed, clusterizer(metals, modes[:-1] + copies))
+	assert output.manifest.written == 0
+	assert output.manifest.skipped == len(full)
+	assert output.stale == stale
+	assert readTree(resumed, stale) == full
+
+@pytest.mark.parametrize('format', ['tar', 'zip'])
+def testArchiveIndexOffsets(tmpdir, scaffold, modes, metals, ligands, format):
+	expected = writeScreen(str(tmpdir.join('files')),
+								Clusterizer(scaffold, modes, metals, ligands, lazy=True))
+	archive = str(tmpdir.join('screen.' + format))
+	with G09ArchiveOutput(archive, format) as output:
+		clusterizer = Clusterizer(scaffold, modes, metals, ligands, lazy=True)
+		output.writeAllModes(clusterizer.iterModes())
+
+	members = {}
+	with open(archive, 'rb') as infile:
+		data = infile.read()
+	with open(archive + '.index') as index:
+		for line in index:
+			name, offset, size = line.rstrip('\n').split('\t')
+			members[name] = data[int(offset):int(offset) + int(size)]
+	assert members == expected